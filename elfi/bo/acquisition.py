@@ -5,7 +5,7 @@ import numpy as np
 
 from scipy.stats import truncnorm
 
-from .utils import approx_second_partial_derivative, sum_of_rbf_kernels
+from .utils import approx_second_partial_derivatives, sum_of_rbf_kernels
 from ..utils import stochastic_optimization
 
 logger = logging.getLogger(__name__)
@@ -32,6 +32,8 @@ class AcquisitionBase():
                 bounds : tuple of length 'input_dim' of tuples (min, max)
             and methods
                 evaluate(x) : function that returns model (mean, var, std)
+                evaluate_batch(X) : function that returns model (mean, var)
+                                    arrays at the rows of X (optional)
     n_samples : None or int
         Total number of samples to be sampled, used when part of an
         AcquisitionSchedule object (None indicates no upper bound)
@@ -53,6 +55,15 @@ class AcquisitionBase():
         """
         return NotImplementedError
 
+    def _eval_batch(self, X):
+        """Evaluates the acquisition function values at the rows of 'X'
+
+        Returns
+        -------
+        numpy.array
+        """
+        return np.array([self._eval(x) for x in X])
+
     def acquire(self, n_values, pending_locations=None):
         """Returns the next batch of acquisition points.
 
@@ -192,12 +203,16 @@ class LCBAcquisition(AcquisitionBase):
 
     def _eval(self, x):
         """ Lower confidence bound = mean - k * std """
-        y_m, y_s2, y_s = self.model.evaluate(x)
-        return float(y_m - self.exploration_rate * y_s)
+        return float(self._eval_batch(np.atleast_2d(x))[0])
+
+    def _eval_batch(self, X):
+        y_m, y_s2 = self.model.evaluate_batch(X)
+        return y_m - self.exploration_rate * np.sqrt(y_s2)
 
     def acquire(self, n_values, pending_locations=None):
         ret = super(LCBAcquisition, self).acquire(n_values, pending_locations)
-        minloc, val = stochastic_optimization(self._eval, self.model.bounds, self.opt_iterations)
+        minloc, val = stochastic_optimization(self._eval_batch, self.model.bounds,
+                                              self.opt_iterations, vectorized=True)
         for i in range(self.n_values):
             ret[i] = minloc
         return ret
@@ -243,11 +258,12 @@ class RbfAtPendingPointsMixin(AcquisitionBase):
         self.rbf_amplitude = rbf_amplitude
         super(RbfAtPendingPointsMixin, self).__init__(*args, **kwargs)
 
-    def _eval(self, x):
-        val = super(RbfAtPendingPointsMixin, self)._eval(x)
+    def _eval_batch(self, X):
+        val = super(RbfAtPendingPointsMixin, self)._eval_batch(X)
         if self.pending_locations is None or self.pending_locations.shape[0] < 1:
             return val
-        val += sum_of_rbf_kernels(x, self.pending_locations, self.rbf_amplitude, self.rbf_scale)
+        val += sum_of_rbf_kernels(np.atleast_2d(X), self.pending_locations,
+                                  self.rbf_amplitude, self.rbf_scale)
         return val
 
 
@@ -264,9 +280,10 @@ class SecondDerivativeNoiseMixin(AcquisitionBase):
         for i in range(n_values):
             opt = opts[i]
             loc = list()
+            d2s = approx_second_partial_derivatives(self._eval_batch, opt,
+                    self.second_derivative_delta, self.model.bounds)
             for dim, val in enumerate(opt.tolist()):
-                d2 = approx_second_partial_derivative(self._eval, opt, dim,
-                        self.second_derivative_delta, self.model.bounds)
+                d2 = d2s[dim]
                 # std from mathching second derivative to that of normal
                 # -N(0,std)'' = 1/(sqrt(2pi)std^3) = der2
                 # => std = der2 ** -1/3 * (2*pi) ** -1/6
@@ -1,7 +1,9 @@
 import logging
 import numpy as np
+import scipy.linalg as sl
 import copy
 import GPy
+from GPy.util.linalg import jitchol
 
 logger = logging.getLogger(__name__)
 logging.getLogger("GP").setLevel(logging.WARNING)  # GPy library logger
@@ -37,6 +39,12 @@ class GPyModel():
     max_opt_iters : int
         Number of optimization iterations to run after each observed sample.
 
+    The Cholesky factor of the kernel matrix and the weights K^-1 y of the
+    observations are kept between the updates. With `max_opt_iters=0`, new
+    observations extend them in O(n^2). Otherwise GPy factorizes the kernel matrix
+    of all the observations for the optimization, and they are taken from its
+    posterior.
+
 
     Possible TODOs:
     - allow initialization with samples, which give hints to initial kernel params
@@ -66,6 +74,9 @@ class GPyModel():
         self.optimizer = optimizer
         self.max_opt_iters = max_opt_iters
         self.gp = None
+        self._X = None
+        self._Y = None
+        self._gp_synced = False
         self.set_kernel(kernel, kernel_class, kernel_var, kernel_scale)
 
     def evaluate(self, x):
@@ -83,11 +94,63 @@ class GPyModel():
         if self.gp is None:
             # TODO: return from GP prior
             return 0.0, 0.0, 0.0
-        m, s2 = self.gp.predict(np.atleast_2d(x))
+        m, s2 = self.evaluate_batch(np.atleast_2d(x))
+        m, s2 = float(m[0]), float(s2[0])
         if m != m:
             logger.warning("{}: Mean evaluated to '%s'."
                     .format(self.__class__.__name__, m))
-        return float(m), float(s2), np.sqrt(float(s2))
+        return m, s2, np.sqrt(s2)
+
+    def evaluate_batch(self, X):
+        """Returns the GP model means and variances at the rows of X.
+
+        The kernel is evaluated once for all the locations. The Cholesky factor
+        and the weights of the observations are reused until the next update.
+
+        Parameters
+        ----------
+        X : numpy 2D array
+            locations to evaluate at, shape (n_locations, input_dim)
+
+        Returns
+        -------
+        gp (mean, s2) at X : (numpy 1D array, numpy 1D array)
+        """
+        X = np.atleast_2d(X)
+        if self.gp is None:
+            # TODO: return from GP prior
+            return np.zeros(len(X)), np.zeros(len(X))
+        Kx = self.gp.kern.K(self._X, X)
+        mean = np.dot(Kx.T, self._alpha)[:, 0]
+        v = sl.solve_triangular(self._L, Kx, lower=True)
+        var = self.gp.kern.Kdiag(X) - np.sum(v**2, axis=0) + self._noise_variance
+        return mean, np.maximum(var, 0)
+
+    def evaluate_gradients(self, X):
+        """Returns the gradients of the GP model mean and variance at the rows of X.
+
+        Parameters
+        ----------
+        X : numpy 2D array
+            locations to evaluate at, shape (n_locations, input_dim)
+
+        Returns
+        -------
+        gradients of gp (mean, s2) at X : (numpy 2D array, numpy 2D array)
+            both of shape (n_locations, input_dim)
+        """
+        X = np.atleast_2d(X)
+        if self.gp is None:
+            return np.zeros(X.shape), np.zeros(X.shape)
+        kern = self.gp.kern
+        # Each row of the kernel matrix depends only on its own location
+        d_mean = kern.gradients_X(np.tile(self._alpha.T, (len(X), 1)), X, self._X)
+        Kx = kern.K(self._X, X)
+        v = sl.solve_triangular(self._L, Kx, lower=True)
+        beta = sl.solve_triangular(self._L.T, v, lower=False)
+        d_var = kern.gradients_X_diag(np.ones(len(X)), X) - \
+            kern.gradients_X(2*beta.T, X, self._X)
+        return d_mean, d_var
 
     def eval_mean(self, x):
         """Returns the GP model mean function at x.
@@ -114,7 +177,7 @@ class GPyModel():
         self.noise_var = noise_var
         if self.gp is not None:
             # re-fit gp with new noise variance
-            self._fit_gp(self.gp.X, self.gp.Y)
+            self._fit_gp(self._X, self._Y)
 
     def set_kernel(self, kernel=None, kernel_class=None, kernel_var=None,
                    kernel_scale=None):
@@ -140,7 +203,7 @@ class GPyModel():
                                             lengthscale=self.kernel_scale)
         if self.gp is not None:
             # re-fit gp with new kernel
-            self._fit_gp(self.gp.X, self.gp.Y)
+            self._fit_gp(self._X, self._Y)
 
     def _fit_gp(self, X, Y):
         """Constructs the gp model.
@@ -153,6 +216,51 @@ class GPyModel():
         self.gp.kern.lengthscale.set_prior(GPy.priors.Gamma.from_EV(1.,100.), warning=False)
         self.gp.kern.variance.set_prior(GPy.priors.Gamma.from_EV(1.,100.), warning=False)
         self.gp.likelihood.variance.set_prior(GPy.priors.Gamma.from_EV(1.,100.), warning=False)
+        self._X = X
+        self._Y = Y
+        self._gp_synced = True
+        self._use_gp_posterior()
+
+    def _factorize(self):
+        """Computes the Cholesky factor L of the kernel matrix of the observations
+        and the weights alpha = K^-1 y.
+        """
+        K = self.gp.kern.K(self._X) + self._noise_variance*np.eye(len(self._X))
+        self._L = jitchol(K)
+        self._Ly = sl.solve_triangular(self._L, self._Y, lower=True)
+        self._alpha = sl.solve_triangular(self._L.T, self._Ly, lower=False)
+
+    def _use_gp_posterior(self):
+        """Takes the Cholesky factor and the weights from the GPy posterior, which
+        is computed whenever the data or the hyperparameters of the GPy model change.
+        """
+        posterior = self.gp.posterior
+        self._L = posterior.woodbury_chol
+        self._alpha = posterior.woodbury_vector
+        self._Ly = np.dot(self._L.T, self._alpha)
+
+    def _extend_factorization(self, X, Y):
+        """Extends the Cholesky factor and the weights with new observations.
+
+        Costs O(n^2) for each new observation.
+        """
+        B = sl.solve_triangular(self._L, self.gp.kern.K(self._X, X), lower=True)
+        K_new = self.gp.kern.K(X) + self._noise_variance*np.eye(len(X))
+        C = jitchol(K_new - np.dot(B.T, B))
+        Ly_new = sl.solve_triangular(C, Y - np.dot(B.T, self._Ly), lower=True)
+
+        n, k = len(self._X), len(X)
+        L = np.zeros((n + k, n + k))
+        L[:n, :n] = self._L
+        L[n:, :n] = B.T
+        L[n:, n:] = C
+        self._L = L
+        self._Ly = np.vstack((self._Ly, Ly_new))
+        self._alpha = sl.solve_triangular(self._L.T, self._Ly, lower=False)
+
+    @property
+    def _noise_variance(self):
+        return float(self.gp.likelihood.variance)
 
     def _within_bounds(self, x):
         """Returns true if location x is within model bounds.
@@ -200,10 +308,16 @@ class GPyModel():
         self._check_input(X, Y)
         logger.debug("{}: Observed: %s at %s."
                     .format(self.__class__.__name__, X, Y))
-        if self.gp is not None:
-            X = np.vstack((self.gp.X, X))
-            Y = np.vstack((self.gp.Y, Y))
-        self._fit_gp(X, Y)
+        if self.gp is None:
+            self._fit_gp(X, Y)
+        else:
+            if self.max_opt_iters < 1:
+                # The optimization would factorize the kernel matrix anew
+                self._extend_factorization(X, Y)
+            self._X = np.vstack((self._X, X))
+            self._Y = np.vstack((self._Y, Y))
+            # The data is passed to GPy only when the hyperparameters are optimized
+            self._gp_synced = False
         self.optimize()
 
     def optimize(self, max_opt_iters=None, fail_on_error=False):
@@ -224,13 +338,37 @@ class GPyModel():
             max_opt_iters = self.max_opt_iters
         if max_opt_iters < 1:
             return
+        # New observations are not in the factor (see `update`)
+        new_data = not self._gp_synced
+        if new_data:
+            self.gp.set_XY(self._X, self._Y)
+            self._gp_synced = True
+        params = self.gp.param_array.copy()
         try:
             self.gp.optimize(self.optimizer, max_iters=max_opt_iters)
         except np.linalg.linalg.LinAlgError:
             logger.warning("{}: Numerical error in GP optimization. Attempting to continue."
                     .format(self.__class__.__name__))
+            if not np.array_equal(params, self.gp.param_array):
+                # The GPy posterior may not match the interrupted parameters
+                self._factorize()
+            elif new_data:
+                self._use_gp_posterior()
             if fail_on_error is True:
                 raise
+        else:
+            if new_data or not np.array_equal(params, self.gp.param_array):
+                self._use_gp_posterior()
+
+    @property
+    def X(self):
+        """Returns the observation locations in rows."""
+        return self._X
+
+    @property
+    def Y(self):
+        """Returns the observed values in rows."""
+        return self._Y
 
     @property
     def n_observations(self):
@@ -238,7 +376,7 @@ class GPyModel():
         """
         if self.gp is None:
             return 0
-        return self.gp.num_data
+        return len(self._X)
 
     def copy(self):
         model = GPyModel(input_dim=self.input_dim,
@@ -248,6 +386,6 @@ class GPyModel():
                          optimizer=self.optimizer,
                          max_opt_iters=self.max_opt_iters)
         if self.gp is not None:
-            model._fit_gp(self.gp.X[:], self.gp.Y[:])
+            model._fit_gp(self._X.copy(), self._Y.copy())
         return model
 
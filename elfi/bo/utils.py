@@ -22,13 +22,31 @@ def approx_second_partial_derivative(fun, x0, dim, h, bounds):
         val_m = fun(x0 - h*d)
     return (val_p - 2*val + val_m) / (h ** 2)
 
+def approx_second_partial_derivatives(fun_batch, x0, h, bounds):
+    """
+        Approximates the second partial derivatives of function
+        'fun_batch' at 'x0' in all dimensions like
+        'approx_second_partial_derivative'. The function is evaluated
+        once at all the needed points, which are given in rows.
+    """
+    x0 = np.asarray(x0, dtype=float)
+    steps = h*np.eye(len(x0))
+    vals = np.asarray(fun_batch(np.vstack((x0, x0 + steps, x0 - steps))))
+    val, val_p, val_m = vals[0], vals[1:len(x0)+1], vals[len(x0)+1:]
+    # Near the bounds, use a symmetric approximation
+    upper = x0 + h > np.array([b[1] for b in bounds])
+    lower = x0 - h < np.array([b[0] for b in bounds])
+    val_p, val_m = (np.where(upper, val_m, val_p),
+                    np.where(upper, val_m, np.where(lower, val_p, val_m)))
+    return (val_p - 2*val + val_m) / (h ** 2)
+
 def sum_of_rbf_kernels(point, kern_centers, kern_ampl, kern_scale):
     """
         Calculates the sum of kernel weights at 'point' given that
         there is one RBF kernel at each 'kern_center' and they
         all have same amplitudes and scales.
 
-        type(point) = np.array_1d
+        type(point) = np.array_1d, or np.array_2d (points on rows)
         type(kern_certers) = np.array_2d (centers on rows)
     """
     if kern_scale <= 0:
@@ -41,11 +59,12 @@ def sum_of_rbf_kernels(point, kern_centers, kern_ampl, kern_scale):
         return 0
     if len(kern_centers) == 0:
         return 0
-    if kern_centers.shape[1] != point.shape[0]:
+    if kern_centers.shape[1] != point.shape[-1]:
         raise ValueError("kern_centers shape must match point shape")
-    ret = 0
-    for i in range(kern_centers.shape[0]):
-        sqdist = sum((kern_centers[i,:] - point) ** 2)
-        ret += kern_ampl * np.exp(-sqdist / kern_scale)
+    points = np.atleast_2d(point)
+    sqdist = np.sum((points[:, None, :] - kern_centers[None, :, :]) ** 2, axis=2)
+    ret = kern_ampl * np.sum(np.exp(-sqdist / kern_scale), axis=1)
+    if point.ndim == 1:
+        return ret[0]
     return ret
 
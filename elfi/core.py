@@ -1,13 +1,25 @@
+import bisect
 import itertools
+import logging
+import uuid
 from functools import partial
 
 import numpy as np
+try:
+    from dask.local import get_sync
+except ImportError:
+    # dask < 0.13
+    from dask.async import get_sync
+from dask.delayed import Delayed
+from distributed.client import Future
 
 from elfi.utils import *
 from elfi.storage import ElfiStore, LocalDataStore, MemoryStore
 from elfi.graph import Node
 from elfi import env
 
+logger = logging.getLogger(__name__)
+
 # TODO: enforce this?
 DEFAULT_DATATYPE = np.float32
 
@@ -51,6 +63,9 @@ def prepare_store(store):
 
 class DelayedOutputCache:
     """Handles a continuous list of delayed outputs for a node.
+
+    The outputs are indexed by their start offsets and keys, so that appending,
+    slice lookups and the store callbacks do not scan the whole list.
     """
     def __init__(self, node_id, store=None):
         """
@@ -64,30 +79,58 @@ class DelayedOutputCache:
         """
         self._delayed_outputs = []
         self._stored_mask = []
+        # Content tokens of the outputs (see `Transform.get_slice`)
+        self._tokens = []
+        # Sorted start offsets of the outputs for bisect lookups
+        self._starts = []
+        # Maps output keys to their position in `self._delayed_outputs`
+        self._positions = {}
+        self._len = 0
         self._store = prepare_store(store)
         self._node_id = node_id
 
     def __len__(self):
-        l = 0
-        for o in self._delayed_outputs:
-            l += slen(get_key_slice(o.key))
-        return l
+        return self._len
 
-    def append(self, output):
+    def append(self, output, token=None):
         """Appends output to cache/store
 
+        Parameters
+        ----------
+        output : dask.delayed object
+        token : str, optional
+            content token of the output
         """
-        if len(self) != get_key_slice(output.key).start:
+        output_sl = get_key_slice(output.key)
+        if self._len != output_sl.start:
             raise ValueError('Appending a non matching slice')
 
+        self._positions[output.key] = len(self._delayed_outputs)
+        self._starts.append(output_sl.start)
         self._delayed_outputs.append(output)
         self._stored_mask.append(False)
+        self._tokens.append(token)
+        self._len += slen(output_sl)
         if self._store:
             self._store.write(output, done_callback=self._set_stored)
 
+    def replace(self, output):
+        """Replaces the output having the same key as `output`.
+
+        The new output must yield the same data as the old one.
+        """
+        i = self._positions.get(output.key)
+        if i is None:
+            raise LookupError('Cannot find output with the given key')
+        self._delayed_outputs[i] = output
+
     def reset(self, new_node_id):
         del self._delayed_outputs[:]
         del self._stored_mask[:]
+        del self._tokens[:]
+        del self._starts[:]
+        self._positions.clear()
+        self._len = 0
         if self._store is not None:
             self._store.reset(self._node_id)
         self._node_id = new_node_id
@@ -104,37 +147,63 @@ class DelayedOutputCache:
             empty = np.zeros(shape=(0,0))
             output = delayed(empty)
         elif len(outputs) == 1:
-            output = outputs[0]
+            output_data, sub_sl = outputs[0]
+            output = output_data
+            if sub_sl is not None:
+                # A view to the single overlapping output
+                intsect_sl = slice_intersect(get_key_slice(output_data.key), sl)
+                key = reset_key_slice(output_data.key, intsect_sl)
+                output = keyed_delayed(key, operator.getitem, output_data, sub_sl)
         else:
-            key = reset_key_slice(outputs[0].key, sl)
-            output = delayed(np.vstack)(tuple(outputs), dask_key_name=key)
+            # Copy the overlapping parts into one preallocated output
+            data_list, sub_slices = zip(*outputs)
+            key = reset_key_slice(data_list[0].key, sl)
+            output = keyed_delayed(key, stack_slices, list(data_list), list(sub_slices))
         return output
 
+    def get_tokens(self, sl):
+        """Returns the content tokens of the outputs intersecting `sl`."""
+        i = max(bisect.bisect_right(self._starts, sl.start) - 1, 0)
+        j = bisect.bisect_left(self._starts, sl.stop)
+        return self._tokens[i:j]
+
     def get(self, index):
-        for d in self._delayed_outputs:
-            if index == get_key_index(d.key):
-                return d
-        raise IndexError("Output with index {} not found".format(index))
+        i = bisect.bisect_left(self._starts, index)
+        if i == len(self._starts) or self._starts[i] != index:
+            raise IndexError("Output with index {} not found".format(index))
+        return self._delayed_outputs[i]
 
     def _get_output_datalist(self, sl):
+        """Returns the delayed data of the outputs intersecting `sl`.
+
+        Returns
+        -------
+        list of tuples (delayed data, sub slice of the data or None if the whole
+        data is used)
+        """
         data_list = []
-        for i, output in enumerate(self._delayed_outputs):
+        # The first output that may intersect with `sl`
+        i = max(bisect.bisect_right(self._starts, sl.start) - 1, 0)
+        for i in range(i, len(self._delayed_outputs)):
+            if self._starts[i] >= sl.stop:
+                break
+            output = self._delayed_outputs[i]
             output_sl = get_key_slice(output.key)
             intsect_sl = slice_intersect(output_sl, sl)
             if slen(intsect_sl) == 0:
                 continue
 
+            output_data = None
             if self._stored_mask[i] == True:
                 output_data = self._store.read_data(self._node_id, output_sl)
-            else:
+            if output_data is None:
+                # Not stored or released from the store
                 output_data = get_named_item(output, 'data')
 
+            sub_sl = None
             if slen(intsect_sl) != slen(output_sl):
-                # Take a subset of the data-slice
-                intsect_key = reset_key_slice(output_data.key, intsect_sl)
                 sub_sl = slice_intersect(intsect_sl, offset=output_sl.start)
-                output_data = delayed(operator.getitem)(output_data, sub_sl, dask_key_name=intsect_key)
-            data_list.append(output_data)
+            data_list.append((output_data, sub_sl))
         return data_list
 
     def _set_stored(self, key, result):
@@ -147,12 +216,10 @@ class DelayedOutputCache:
         key : key of the original output
         result : future or concrete result of the output (currently not used)
         """
-        output = [i for i,o in enumerate(self._delayed_outputs) if o.key == key]
-        if len(output) != 1:
+        i = self._positions.get(key)
+        if i is None:
             # TODO: this error doesn't actually currently propagate into the main thread
-            # Also make a separate case for len > 1
             raise LookupError('Cannot find output with the given key')
-        i = output[0]
         self._stored_mask[i] = True
 
 
@@ -164,7 +231,7 @@ def to_output_dict(input_dict, **kwargs):
 
 
 # TODO: this could have similar logic as utils.atleast_2d
-def normalize_data(data, n=1):
+def normalize_data(data, n=1, writable=False):
     """Translates user-originated data into format compatible with the core.
 
     Parameters
@@ -173,6 +240,9 @@ def normalize_data(data, n=1):
         User-originated data.
     n : int
         Number of times to replicate data (vectorization).
+    writable : bool
+        If False (default), replicated data is a read-only broadcast view to the data
+        instead of a copy.
 
     Returns
     -------
@@ -242,15 +312,74 @@ def normalize_data(data, n=1):
         else:
             data = data[None, :]
             if n > 1:
-                data = np.vstack((data, ) * n)
+                data = replicate(data, n, writable)
     else:
         if data.shape[0] != n:
             data = data[None, :]
             if n > 1:
-                data = np.vstack((data, ) * n)
+                data = replicate(data, n, writable)
+    return data
+
+
+def replicate(data, n, writable=False):
+    """Replicates the single row of `data` `n` times.
+
+    A pickled view is a full copy, so replicated values are sent to the workers as
+    the single row and replicated in the task (see `Transform._create_delayed_output`).
+
+    Parameters
+    ----------
+    data : np.ndarray
+        array of shape (1, ...)
+    n : int
+    writable : bool
+        If False (default), returns a read-only broadcast view instead of a copy.
+
+    Returns
+    -------
+    np.ndarray of shape (n, ...)
+
+    Examples
+    --------
+    >>> r = replicate(np.array([[1, 2]]), 3)
+    >>> r.shape, r.flags.writeable
+    ((3, 2), False)
+    """
+    data = np.broadcast_to(data, (n, ) + data.shape[1:])
+    if writable:
+        data = data.copy()
     return data
 
 
+def is_replicated(data):
+    """Returns True if `data` is a broadcast view replicating its first row."""
+    return isinstance(data, np.ndarray) and data.ndim > 0 and len(data) > 1 and \
+        data.strides[0] == 0
+
+
+def copy_readonly(data):
+    """Copies the read-only arrays in the tuple `data`.
+
+    Used for operations that modify their input data in place.
+    """
+    return tuple(d.copy() if isinstance(d, np.ndarray) and not d.flags.writeable else d
+                 for d in data)
+
+
+def writable_inputs_transform(input_dict, transform):
+    """Calls `transform` with read-only input data replaced with writable copies."""
+    input_dict = to_output_dict(input_dict, data=copy_readonly(input_dict["data"]))
+    return transform(input_dict)
+
+
+def apply_transform(transform, input_dict):
+    """Calls `transform` with `input_dict`.
+
+    Allows the transform to be a task argument.
+    """
+    return transform(input_dict)
+
+
 def normalize_data_dict(dict, n):
     if dict is None:
         return None
@@ -261,6 +390,9 @@ def normalize_data_dict(dict, n):
 
 
 class Transform(Node):
+    # Whether the outputs are saved to the simulation cache (see `get_slice`)
+    cacheable = True
+
     def __init__(self, name, transform, *parents, inference_task=None, store=None):
         """Transforms take `input_dict` as an argument and turn it into `output_dict`
 
@@ -286,6 +418,9 @@ class Transform(Node):
         # Keeps track of the resets
         self._num_resets = 0
         self._delayed_outputs = DelayedOutputCache(self.id, store)
+        # Handles to the static payloads scattered to the workers
+        self._static_payloads = {}
+        self._structure_token = None
 
     def acquire(self, n, starting=0, batch_size=None):
         """Acquires values from the start or from starting index.
@@ -342,6 +477,42 @@ class Transform(Node):
         self._generate_index = b
         return self[slice(a, b)]
 
+    def evaluate_at(self, values, batch_size=None, client=None):
+        """Evaluates the node at many points in a single batch.
+
+        The points are generated together with `generate`, so that e.g. the simulator
+        is called once for all of them. The outputs of the points are submitted to the
+        client together and each point gets its own future.
+
+        Parameters
+        ----------
+        values : dict(node_name: np.array) or np.ndarray
+            Values with one point per row. A 2d array is split by columns to the
+            parameters of the inference task.
+        batch_size : int, optional
+            Maximum number of points in one batch. Default all the points.
+        client : distributed.Client, optional
+            Default `elfi.env.client()`.
+
+        Returns
+        -------
+        list of distributed.Future objects, one for each point
+        """
+        if isinstance(values, np.ndarray):
+            parameters = self.inference_task.parameters
+            if values.ndim != 2 or values.shape[1] != len(parameters):
+                raise ValueError("Expected a 2d array with one column per parameter. " +
+                                 "Received shape == {}.".format(values.shape))
+            values = {p.name: values[:, i:i+1] for i, p in enumerate(parameters)}
+        values = {k: atleast_2d(v) for k, v in values.items()}
+        n = len(next(iter(values.values())))
+
+        a = self._generate_index
+        self.generate(n, batch_size=batch_size, with_values=values)
+        client = client or env.client()
+        # Computing the rows separately would compute their batch for each of them
+        return client.compute([self[i] for i in range(a, a + n)])
+
     def __getitem__(self, sl):
         sl = to_slice(sl)
         return self._delayed_outputs[sl]
@@ -352,6 +523,12 @@ class Transform(Node):
         This function is ensured to give a slice anywhere (already generated or not)
         Does not update _generate_index
 
+        If the ELFI environment option `cache` is set to a `SimulationCache`, new outputs
+        are identified by content tokens computed from the structure token of the node,
+        the tokens of the parent outputs, the random sub stream and the slice. Outputs
+        found in the cache are loaded instead of computed, and computed outputs are
+        saved to it.
+
         Parameters
         ----------
         sl : slice
@@ -370,8 +547,12 @@ class Transform(Node):
                                               sl.stop - len(self._delayed_outputs))
             new_sl = slice(len(self._delayed_outputs), sl.stop)
             new_input = self._create_input_dict(new_sl, with_values=with_values)
-            new_output = self._create_delayed_output(new_sl, new_input, with_values)
-            self._delayed_outputs.append(new_output)
+            token = None
+            if env.get_option('cache') is not None:
+                token = self._output_token(new_sl, with_values)
+            new_output = self._create_delayed_output(new_sl, new_input, with_values,
+                                                     token)
+            self._delayed_outputs.append(new_output, token)
         return self[sl]
 
     def get_delayed_output(self, index):
@@ -395,6 +576,25 @@ class Transform(Node):
         """Sets the transform of the node directly
         """
         self._transform = transform
+        self.clear_static_payloads()
+        self.clear_structure_token()
+
+    @property
+    def structure_token(self):
+        """Token identifying the transform of the node. See `elfi.utils.make_token`."""
+        if self._structure_token is None:
+            self._structure_token = make_token(*self._structure_parts())
+        return self._structure_token
+
+    def clear_structure_token(self):
+        """Clears the structure token.
+
+        Must be called if the transform is modified in place.
+        """
+        self._structure_token = None
+
+    def _structure_parts(self):
+        return [self.__class__.__name__, self._transform]
 
     @property
     def version(self):
@@ -417,6 +617,8 @@ class Transform(Node):
             self.remove_parents()
             self.add_parents(parents)
         self._transform = transform
+        self.clear_static_payloads()
+        self.clear_structure_token()
         if reset:
             self.reset()
 
@@ -437,6 +639,43 @@ class Transform(Node):
         self._generate_index = 0
         self._num_resets += 1
         self._delayed_outputs.reset(self.id)
+        self.clear_static_payloads()
+
+    def clear_static_payloads(self):
+        """Releases the static payloads scattered to the workers.
+
+        Must be called if an object that has been broadcast is modified in place.
+        """
+        self._static_payloads.clear()
+
+    def _static_payload(self, name, obj):
+        """Returns `obj` or a delayed handle to its copy on every worker.
+
+        If the ELFI environment option `broadcast` is set, `obj` is scattered to all the
+        workers of the client once and tasks refer to it by the returned handle.
+
+        Parameters
+        ----------
+        name : str
+            name of the payload
+        obj : object
+
+        Returns
+        -------
+        `obj` or dask.delayed object
+        """
+        if not env.get_option('broadcast'):
+            return obj
+        client = env.client()
+        client_payload = self._static_payloads.get(name)
+        if client_payload is None or client_payload[0] is not client:
+            key = "{}/{}-{}".format(self.id, name, uuid.uuid4().hex)
+            future = client.scatter({key: obj}, broadcast=True)[key]
+            # The scheduler inlines the future in place of the reference key
+            ref_key = key + '/ref'
+            client_payload = (client, Delayed(ref_key, [{ref_key: future}]))
+            self._static_payloads[name] = client_payload
+        return client_payload[1]
 
     def _create_input_dict(self, sl, with_values=None):
         n = sl.stop - sl.start
@@ -447,7 +686,30 @@ class Transform(Node):
             "index": sl.start,
         }
 
-    def _create_delayed_output(self, sl, input_dict, with_values=None):
+    def _output_token(self, sl, with_values=None):
+        """Returns the content token of a new output, or None if the content of some
+        parent output is not known.
+
+        Parameters
+        ----------
+        sl : slice
+        with_values : dict {'node_name': np.array}
+
+        Returns
+        -------
+        str or None
+        """
+        if with_values is not None and self.name in with_values:
+            return make_token(with_values[self.name])
+        parts = [self.structure_token, sl.start, slen(sl)]
+        for p in self.parents:
+            tokens = p._delayed_outputs.get_tokens(sl)
+            if None in tokens:
+                return None
+            parts.append(tokens)
+        return make_token(*parts)
+
+    def _create_delayed_output(self, sl, input_dict, with_values=None, token=None):
         """
 
         Parameters
@@ -455,6 +717,8 @@ class Transform(Node):
         sl : slice
         input_dict : dict
         with_values : dict {'node_name': np.array}
+        token : str, optional
+            content token of the output for the simulation cache
 
         Returns
         -------
@@ -465,12 +729,26 @@ class Transform(Node):
         dask_key = make_key(self.id, sl)
         if self.name in with_values:
             # Set the data to with_values
-            output = to_output_dict(input_dict, data=with_values[self.name])
-            return delayed(output, name=dask_key)
-        else:
-            dinput = delayed(input_dict, pure=True)
-            return delayed(self._transform)(dinput,
-                                            dask_key_name=dask_key)
+            data = with_values[self.name]
+            if is_replicated(data):
+                # Pickling would copy the rows, so the task replicates the single row
+                data = keyed_delayed(make_key(self.id + '/replicated', sl), replicate,
+                                     np.array(data[:1]), len(data))
+            output = to_output_dict(input_dict, data=data)
+            return keyed_delayed(dask_key, dict, output)
+
+        cache = env.get_option('cache')
+        use_cache = cache is not None and token is not None and self.cacheable
+        if use_cache and token in cache:
+            return keyed_delayed(dask_key, cache.load, token)
+
+        dinput = keyed_delayed(make_key(self.id + '/input', sl), dict, input_dict)
+        transform = self._static_payload('transform', self._transform)
+        if not use_cache:
+            return keyed_delayed(dask_key, apply_transform, transform, dinput)
+        output = keyed_delayed(make_key(self.id + '/uncached', sl), apply_transform,
+                               transform, dinput)
+        return keyed_delayed(dask_key, cache.save, token, output)
 
     def _convert_to_node(self, obj, name):
         return Constant(name, obj)
@@ -486,6 +764,10 @@ for the constructor. They may also add keys to `input_dict` and `output_dict`.
 def get_substream_state(master_seed, substream_index):
     """Returns PRNG internal state for the sub stream
 
+    This is the legacy definition of the sub streams. It draws `substream_index+1` seeds
+    from the master stream on every call. Inference tasks use a `SubstreamProvider`
+    instead, which has a compatibility mode reproducing these streams.
+
     Parameters
     ----------
     master_seed : uint32
@@ -499,6 +781,7 @@ def get_substream_state(master_seed, substream_index):
     See Also
     --------
     'numpy.random.RandomState.get_state' for the representation of MT19937 state
+    `elfi.utils.SubstreamProvider`
     """
     # Fixme: In the future, allow MRG32K3a from https://pypi.python.org/pypi/randomstate
     seeds = np.random.RandomState(master_seed)\
@@ -514,12 +797,20 @@ class RandomStateMixin(Transform):
 
     def _create_input_dict(self, sl, **kwargs):
         dct = super(RandomStateMixin, self)._create_input_dict(sl, **kwargs)
-        dct["random_state"] = self._get_random_state()
+        dct["random_state"] = self._get_random_state(sl)
         return dct
 
-    def _get_random_state(self):
-        it = self.inference_task
-        return delayed(get_substream_state, pure=True)(it.seed, it.new_substream_index())
+    def _get_random_state(self, sl):
+        # The seed of the latest batch is a part of its content token
+        self._batch_seed = self.inference_task.new_substream_seed()
+        return keyed_delayed(make_key(self.id + '/random_state', sl), get_seed_state,
+                             self._batch_seed)
+
+    def _output_token(self, sl, with_values=None):
+        token = super(RandomStateMixin, self)._output_token(sl, with_values)
+        if token is None or (with_values is not None and self.name in with_values):
+            return token
+        return make_token(token, self._batch_seed)
 
 
 class ObservedMixin(Transform):
@@ -570,6 +861,9 @@ class Constant(ObservedMixin, Transform):
     Constant. Holds a constant value and returns only that when asked to generate data.
     Observed value is set also to the same value.
     """
+    # Constants are cheaper to compute than to load
+    cacheable = False
+
     def __init__(self, name, value):
         """
 
@@ -602,6 +896,13 @@ class Operation(Transform):
     operation_transform : callable(input_dict, operation)
         Wraps operations to transforms
 
+    Parameters
+    ----------
+    writable_inputs : bool, optional
+        The input data may contain read-only arrays, e.g. broadcast views of values
+        given with `with_values`. Set to True if the operation modifies its input data
+        in place, so that it receives writable copies instead. Default False.
+
     """
     operation_transform = None
 
@@ -621,6 +922,8 @@ class Operation(Transform):
         """
         self._operation = operation
         transform = partial(self.__class__.operation_transform, operation=operation)
+        if kwargs.pop('writable_inputs', False):
+            transform = partial(writable_inputs_transform, transform=transform)
         return transform, kwargs
 
     def redefine(self, operation, *parents, reset=True, **kwargs):
@@ -791,6 +1094,54 @@ def discrepancy_transform(input_dict, operation):
     return to_output_dict(input_dict, data=data)
 
 
+class FusedBatch(object):
+    """Holds the tasks of one batch that are computed as a single task.
+
+    The subgraph is wrapped in an object so that the scheduler does not look into it.
+
+    Parameters
+    ----------
+    dsk : dict
+        dask graph of the batch
+    output_key : tuple
+        key of the output of the fused node
+    data_keys : list
+        keys of the outputs that are exported from the fused task
+    payload_keys : list, optional
+        keys of the static payloads given separately to `compute_fused_batch`
+    """
+    def __init__(self, dsk, output_key, data_keys, payload_keys=None):
+        self.dsk = dsk
+        self.output_key = output_key
+        self.data_keys = data_keys
+        self.payload_keys = payload_keys or []
+
+
+def compute_fused_batch(batch, payloads=None):
+    """Computes the subgraph of a `FusedBatch` in the current process.
+
+    Parameters
+    ----------
+    batch : FusedBatch
+    payloads : list, optional
+        values of the static payloads matching `batch.payload_keys`
+
+    Returns
+    -------
+    out : tuple
+        The output dict of the fused node followed by the output dicts of the
+        exported outputs. The observed data and random states are not included in
+        the outputs.
+    """
+    dsk = batch.dsk
+    if payloads:
+        dsk = dict(dsk)
+        dsk.update(zip(batch.payload_keys, payloads))
+    results = get_sync(dsk, [batch.output_key] + batch.data_keys)
+    return tuple({k: v for k, v in r.items() if k not in ('observed', 'random_state')}
+                 for r in results)
+
+
 class Discrepancy(Operation):
     """Discrepancy operation node.
 
@@ -800,6 +1151,14 @@ class Discrepancy(Operation):
     operation : callable(parent_data, observed_data)
         parent_data : tuple of np.ndarray data objects from parents
         observed_data : tuple of np.ndarray observed data objects from parents
+    fuse : bool or list of nodes, optional
+        Collapse the tasks of each batch of the discrepancy and its ancestors into a
+        single task. Only the outputs of the discrepancy and of the given nodes (if
+        True, the parameters of the inference task) are returned from the task,
+        without the observed data and the random states.
+        The outputs of these nodes are replaced with the ones from the fused task, so
+        they should be computed together with the discrepancy. Fusion is not done if
+        an ancestor has a store. Default False.
 
     See Also
     --------
@@ -808,11 +1167,59 @@ class Discrepancy(Operation):
     """
     operation_transform = discrepancy_transform
 
+    def _init_transform(self, operation, fuse=False, **kwargs):
+        self.fuse = fuse
+        return super(Discrepancy, self)._init_transform(operation, **kwargs)
+
     def _create_input_dict(self, sl, **kwargs):
         dct = super(Discrepancy, self)._create_input_dict(sl, **kwargs)
-        dct["observed"] = tuple([p.observed for p in self.parents])
+        dct["observed"] = self._static_payload('observed',
+                                               tuple([p.observed for p in self.parents]))
         return dct
 
+    def _structure_parts(self):
+        parts = super(Discrepancy, self)._structure_parts()
+        return parts + [tuple([p.observed for p in self.parents])]
+
+    def _create_delayed_output(self, sl, input_dict, with_values=None, token=None):
+        output = super(Discrepancy, self)._create_delayed_output(sl, input_dict,
+                                                                 with_values, token)
+        if self.fuse and self.name not in (with_values or {}) and self._can_fuse():
+            output = self._fuse(sl, output)
+        return output
+
+    def _can_fuse(self):
+        for node in self.ancestors[1:]:
+            if isinstance(node, Transform) and node._delayed_outputs._store is not None:
+                return False
+        return True
+
+    def _fuse(self, sl, output):
+        """Collapses the tasks of the batch `sl` into a single task."""
+        dsk = output.dask
+        exported = self.fuse if isinstance(self.fuse, (list, tuple)) \
+            else self.inference_task.parameters
+        exported = [node for node in exported if make_key(node.id, sl) in dsk]
+        data_keys = [make_key(node.id, sl) for node in exported]
+
+        # The scattered payloads must be resolved by the scheduler
+        payloads = {k: v for k, v in dsk.items() if isinstance(v, Future)}
+        dsk = {k: v for k, v in dsk.items() if k not in payloads}
+        payload_keys = list(payloads.keys())
+
+        batch = FusedBatch(dsk, output.key, data_keys, payload_keys)
+        fused = keyed_delayed(make_key(self.id + '/fused', sl), compute_fused_batch,
+                              batch, [payloads[k] for k in payload_keys])
+        for i, node in enumerate(exported):
+            node._delayed_outputs.replace(
+                keyed_delayed(data_keys[i], operator.getitem, fused, i + 1))
+        output = keyed_delayed(output.key, operator.getitem, fused, 0)
+
+        logger.debug("{}: fused {} tasks of batch {} into 1 task with {} outputs"
+                     .format(self.name, len(dsk), (sl.start, sl.stop),
+                             len(exported) + 1))
+        return output
+
 
 if __name__ == "__main__":
     import doctest
@@ -4,7 +4,13 @@ from functools import partial
 
 import numpy as np
 import numpy.random as npr
+import scipy.linalg as sl
 import scipy.stats as ss
+from scipy.spatial import cKDTree
+try:
+    from scipy.special import logsumexp
+except ImportError:
+    from scipy.misc import logsumexp
 
 from elfi import core
 from elfi import utils
@@ -257,9 +263,22 @@ class SMCProposal():
     Gaussian distributions centered at previous values.
 
     Used in SMC ABC as priors for subsequent particle populations.
+
+    By default all the samples share the kernel covariance `2*weighted_cov`. The
+    local kernels give each sample its own covariance:
+
+    "olcm" : the optimal local covariance matrix of Filippi et al. (2013), computed
+        from the reference samples, typically those that pass the next threshold
+    "knn" : twice the weighted covariance of the `n_neighbors` nearest samples
     """
 
-    def __init__(self, samples=None, weights=1):
+    # Maximum number of kernel evaluations in one block of `logpdf`
+    block_size = 2**20
+
+    kernels = ('global', 'olcm', 'knn')
+
+    def __init__(self, samples=None, weights=1, truncation=None, kernel='global',
+                 n_neighbors=None):
         """
 
         Parameters
@@ -267,13 +286,43 @@ class SMCProposal():
         samples : 2-D array-like, optional
             Observations in rows
         weights : 1-D array-like or numeric, optional
+        truncation : float, optional
+            If given, only the samples within `truncation` kernel standard deviations
+            (in the Mahalanobis distance) of a point contribute to its density. The
+            samples are then searched with a KD-tree. The density is approximate and
+            zero far from all the samples. Only for the global kernel.
+        kernel : str, optional
+            One of "global", "olcm" or "knn".
+        n_neighbors : int, optional
+            Number of neighbours for the "knn" kernel. Defaults to 10 but at least
+            two per dimension.
         """
+        if kernel not in self.kernels:
+            raise ValueError("Unknown kernel {}. Expected one of {}"
+                             .format(kernel, self.kernels))
+        if truncation is not None and kernel != 'global':
+            raise ValueError("Truncation is supported only for the global kernel")
+
         self._samples = None
         self._weights = None
         self._wcov = None
+        self.truncation = truncation
+        self.kernel = kernel
+        self.n_neighbors = n_neighbors
         self.set_population(samples, weights)
 
-    def set_population(self, samples, weights=1):
+    def set_population(self, samples, weights=1, reference=None):
+        """Sets the samples the kernels are centered at.
+
+        Parameters
+        ----------
+        samples : 2-D array-like
+            Observations in rows
+        weights : 1-D array-like or numeric, optional
+        reference : array-like, optional
+            Indices or a boolean mask of the samples that the "olcm" kernel is
+            computed from. Defaults to all samples.
+        """
         self._samples = utils.atleast_2d(samples).astype(core.DEFAULT_DATATYPE)
 
         weights = normalize_weights(weights)
@@ -286,15 +335,21 @@ class SMCProposal():
 
         self._weights = weights
         self._wcov = weighted_cov(self._samples, self._weights)
-
-    def resample(self, size=(1,), random_state=None):
-        size = self._size_to_int(size)
-
+        self._reference = reference
+        self._factorize()
+        # The density terms are computed once per population when first needed
+        self._white_samples = None
+        self._local_chols = None
+        self._tree = None
+
+    def _resample_indices(self, size, random_state=None):
         if random_state is None:
             random_state = np.random
+        return random_state.choice(len(self._samples), size=size, p=self._weights)
 
-        inds = random_state.choice(len(self._samples), size=size, p=self._weights)
-        return self._samples[inds]
+    def resample(self, size=(1,), random_state=None):
+        size = self._size_to_int(size)
+        return self._samples[self._resample_indices(size, random_state)]
 
     def rvs(self, size=(1,), random_state=None):
         """Random value source
@@ -310,29 +365,185 @@ class SMCProposal():
 
         """
         size = self._size_to_int(size)
+        if random_state is None:
+            random_state = np.random
 
-        samples = self.resample(size=size,
-                                random_state=random_state).astype(core.DEFAULT_DATATYPE)
-
-        noise = ss.multivariate_normal.rvs(cov=2*self._wcov,
-                                           random_state=random_state,
-                                           size=size)
-        if size == 1:
-            noise = np.atleast_2d(noise)
-        samples += utils.atleast_2d(noise)
+        inds = self._resample_indices(size, random_state)
+        z = random_state.standard_normal(size=(size, self._samples.shape[1]))
+        if self.kernel == 'global':
+            noise = np.dot(z, self._noise_factor.T)
+        else:
+            self._init_local_kernels()
+            noise = np.einsum('nij,nj->ni', self._local_chols[inds], z)
 
-        return samples
+        return (self._samples[inds] + noise).astype(core.DEFAULT_DATATYPE)
 
     def pdf(self, x):
-        x = utils.atleast_2d(x)
+        """Probability density function at x
+
+        Parameters
+        ----------
+        x : array_like
+            points in rows
+
+        Returns
+        -------
+        np.ndarray
+        """
+        return np.exp(self.logpdf(x))
+
+    def logpdf(self, x):
+        """Logarithm of the probability density function at x
+
+        The kernels are evaluated in the whitened space of the kernel covariance and
+        summed in log-space.
+
+        Parameters
+        ----------
+        x : array_like
+            points in rows
+
+        Returns
+        -------
+        np.ndarray
+        """
+        if self.kernel != 'global':
+            return self._local_logpdf(utils.atleast_2d(x))
+
+        self._init_kernel()
+        z = self._whiten(utils.atleast_2d(x))
+        if self.truncation is not None:
+            return self._truncated_logpdf(z)
+
+        vals = np.zeros(len(z))
+        w = self._white_samples
+        w_sq = np.sum(w**2, axis=1)
+        n_block = max(1, self.block_size // len(w))
+        for i in range(0, len(z), n_block):
+            zb = z[i:i + n_block]
+            sq_dist = np.sum(zb**2, axis=1)[:, None] + w_sq[None, :] - 2*np.dot(zb, w.T)
+            vals[i:i + n_block] = self._sum_kernels(np.maximum(sq_dist, 0),
+                                                    self._log_weights)
+        return vals
+
+    def _factorize(self):
+        """Factorizes the kernel covariance for sampling and density evaluation."""
+        cov = 2*self._wcov
+        try:
+            self._kernel_chol = sl.cholesky(cov, lower=True)
+        except np.linalg.LinAlgError:
+            # A singular covariance can still be sampled from but has no density
+            self._kernel_chol = None
+            s, u = sl.eigh(cov)
+            self._noise_factor = u*np.sqrt(np.maximum(s, 0))
+            return
+        self._noise_factor = self._kernel_chol
+        dim = self._samples.shape[1]
+        self._log_kernel_norm = -.5*dim*np.log(2*np.pi) - \
+            np.sum(np.log(np.diag(self._kernel_chol)))
+
+    def _init_kernel(self):
+        """Whitens the samples."""
+        if self._white_samples is not None:
+            return
+        if self._kernel_chol is None:
+            raise np.linalg.LinAlgError("The kernel covariance is singular")
+        self._white_samples = self._whiten(self._samples)
+        with np.errstate(divide='ignore'):
+            self._log_weights = np.log(self._weights)
+
+    def _init_local_kernels(self):
+        """Factorizes the covariances of the local kernels."""
+        if self._local_chols is not None:
+            return
+        if self.kernel == 'olcm':
+            covs = self._olcm_covs()
+        else:
+            covs = self._knn_covs()
+        self._local_chols = np.linalg.cholesky(covs)
+        self._local_inv_chols = np.linalg.inv(self._local_chols)
+        dim = self._samples.shape[1]
+        self._log_local_norms = -.5*dim*np.log(2*np.pi) - \
+            np.sum(np.log(np.diagonal(self._local_chols, axis1=1, axis2=2)), axis=1)
+        with np.errstate(divide='ignore'):
+            self._log_weights = np.log(self._weights)
+
+    def _olcm_covs(self):
+        """Optimal local covariances sum_k w_k (x_k - x_i)(x_k - x_i)^T over the
+        reference samples x_k.
+        """
+        samples = self._samples
+        weights = self._weights
+        if self._reference is not None and len(samples[self._reference]) > 0:
+            samples = samples[self._reference]
+            weights = normalize_weights(weights[self._reference])
+        mean = np.average(samples, axis=0, weights=weights)
+        centered = samples - mean
+        cov = np.dot(centered.T, weights[:, None]*centered)
+        diff = self._samples - mean
+        covs = cov[None, :, :] + diff[:, :, None]*diff[:, None, :]
+        # E.g. when there are no more reference samples than dimensions
+        return self._replace_singular(covs)
+
+    def _knn_covs(self):
+        """Twice the weighted covariances of the nearest neighbours of each sample."""
+        n, dim = self._samples.shape
+        k = self.n_neighbors or max(2*dim, 10)
+        k = min(max(k, 2), n)
+        _, inds = cKDTree(self._samples).query(self._samples, k=k)
+
+        x = self._samples[inds]
+        w = self._weights[inds]
+        w = w / np.sum(w, axis=1, keepdims=True)
+        x = x - np.sum(w[:, :, None]*x, axis=1, keepdims=True)
+        with np.errstate(divide='ignore'):
+            a = 1/(1 - np.sum(w**2, axis=1))
+        with np.errstate(invalid='ignore'):
+            covs = 2*a[:, None, None]*np.einsum('nk,nki,nkj->nij', w, x, x)
+        # The neighbourhood is degenerate, e.g. with no more neighbours than dimensions
+        covs[~np.isfinite(a)] = 2*self._wcov
+        return self._replace_singular(covs)
+
+    def _replace_singular(self, covs):
+        """Replaces the singular local covariances with the global kernel covariance."""
+        eigs = np.linalg.eigvalsh(covs)
+        singular = eigs[:, 0] <= 1e-10*np.abs(eigs[:, -1])
+        covs[singular] = 2*self._wcov
+        return covs
+
+    def _local_logpdf(self, x):
+        self._init_local_kernels()
+        n, dim = self._samples.shape
         vals = np.zeros(len(x))
-        d = ss.multivariate_normal(mean=[0]*self._samples.shape[1],
-                                   cov=2*self._wcov)
-        for i in range(len(x)):
-            xi = x[i,:] - self._samples
-            vals[i] = np.sum(self._weights * d.pdf(xi))
+        n_block = max(1, self.block_size // (n*dim))
+        for i in range(0, len(x), n_block):
+            diff = x[i:i + n_block, None, :] - self._samples[None, :, :]
+            z = np.einsum('nij,mnj->mni', self._local_inv_chols, diff)
+            log_kernels = self._log_local_norms - .5*np.sum(z**2, axis=2)
+            with np.errstate(divide='ignore'):
+                vals[i:i + n_block] = logsumexp(self._log_weights + log_kernels, axis=-1)
+        return vals
+
+    def _truncated_logpdf(self, z):
+        if self._tree is None:
+            self._tree = cKDTree(self._white_samples)
+        vals = np.full(len(z), -np.inf)
+        for i, inds in enumerate(self._tree.query_ball_point(z, self.truncation)):
+            if len(inds) > 0:
+                sq_dist = np.sum((self._white_samples[inds] - z[i])**2, axis=1)
+                vals[i] = self._sum_kernels(sq_dist, self._log_weights[inds])
         return vals
 
+    def _sum_kernels(self, sq_dist, log_weights):
+        """Log of the weighted sum of the kernels along the last axis."""
+        with np.errstate(divide='ignore'):
+            return logsumexp(log_weights - .5*sq_dist, axis=-1) + self._log_kernel_norm
+
+    def _whiten(self, x):
+        """Transforms the points in rows of `x` so that the kernel covariance is unit."""
+        return sl.solve_triangular(self._kernel_chol, np.asarray(x, dtype=float).T,
+                                   lower=True).T
+
     @property
     def size(self):
         return self._samples[0].shape
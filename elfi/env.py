@@ -9,7 +9,7 @@ from elfi.inference_task import InferenceTask
 logging.getLogger('tornado').setLevel(logging.WARNING)
 
 _globals = defaultdict(lambda: None)
-_whitelist = ["client", "inference_task"]
+_whitelist = ["client", "inference_task", "broadcast", "cache"]
 
 
 def set_option(**kwargs):
@@ -18,6 +18,12 @@ def set_option(**kwargs):
     Parameters
     ----------
     client : dask.distributed client object
+    broadcast : bool
+        Scatter the static payloads of the nodes (transforms, constants and observed
+        data) to all workers once instead of including them in every task.
+        Requires computing with the distributed client.
+    cache : `elfi.storage.SimulationCache`
+        Persistent cache of the node outputs. See `elfi.core.Transform.get_slice`.
 
     Examples
     --------
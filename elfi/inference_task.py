@@ -1,4 +1,5 @@
 from elfi.graph import Graph
+from elfi.utils import SubstreamProvider
 
 
 class InferenceTask(Graph):
@@ -15,7 +16,8 @@ class InferenceTask(Graph):
     # Index of the default named `InferenceTask` to differentiate them
     default_task_index = 0
 
-    def __init__(self, parameters=None, name=None, seed=0, sub_stream_index=0):
+    def __init__(self, parameters=None, name=None, seed=0, sub_stream_index=0,
+                 substream_mode="keyed"):
         """
 
         Parameters
@@ -24,19 +26,40 @@ class InferenceTask(Graph):
         name : hashable
         seed : uint32
         sub_stream_index : uint
+        substream_mode : str
+            "keyed" (default) or "legacy". The latter reproduces the random sub streams
+            of ELFI versions <= 0.3.1. See `elfi.utils.SubstreamProvider`.
 
         """
         super(InferenceTask, self).__init__(name)
         self.parameters = parameters or []
         self.name = None
         self._set_name(name)
-        self.seed = seed
+        self.substreams = SubstreamProvider(seed, substream_mode)
         self.sub_stream_index = sub_stream_index
 
+    @property
+    def seed(self):
+        return self.substreams.master_seed
+
+    @seed.setter
+    def seed(self, seed):
+        self.substreams = SubstreamProvider(seed, self.substreams.mode)
+
     def new_substream_index(self):
         self.sub_stream_index += 1
         return self.sub_stream_index
 
+    def new_substream_seed(self):
+        """Takes a new sub stream into use and returns its seed.
+
+        Returns
+        -------
+        seed : int or tuple of ints
+            See `elfi.utils.get_seed_state`
+        """
+        return self.substreams.get_seed(self.new_substream_index())
+
     @property
     def discrepancy(self):
         # FIXME: redesign the dependencies so that Discrepancy can be imported on top
@@ -1,3 +1,4 @@
+import copy
 import logging
 from functools import partial
 
@@ -8,6 +9,7 @@ from distributed import Client
 from elfi import core, Result, Result_SMC
 from elfi import Discrepancy, Transform
 from elfi import storage
+from elfi import utils
 from elfi.async import wait, next_result
 from elfi.env import client as elfi_client
 from elfi.distributions import Prior, SMCProposal
@@ -121,13 +123,15 @@ class ABCMethod(object):
         """Rounds up n to the nearest higher integer divisible with `self.batch_size`."""
         return int(np.ceil(n / self.batch_size)) * self.batch_size
 
-    def _acquire(self, n_sim, verbose=True):
+    def _acquire(self, n_sim, verbose=True, starting=0):
         """Acquires n_sim distances and parameters
 
         Parameters
         ----------
         n_sim : int
             number of values to compute
+        starting : int, optional
+            index of the first value
 
         Returns
         -------
@@ -139,10 +143,12 @@ class ABCMethod(object):
         if verbose:
             logger.info("{}: Running with {} proposals.".format(self.__class__.__name__,
                                                                 n_sim))
-        distances = self.distance_node.acquire(n_sim,
-                                               batch_size=self.batch_size).compute()
-        parameters = [p.acquire(n_sim, batch_size=self.batch_size).compute()
+        distances = self.distance_node.acquire(n_sim, starting=starting,
+                                               batch_size=self.batch_size)
+        parameters = [p.acquire(n_sim, starting=starting, batch_size=self.batch_size)
                       for p in self.parameter_nodes]
+        # Compute in a single pass so that the shared ancestors are computed once
+        distances, *parameters = dask.compute(distances, *parameters)
 
         return distances, parameters
 
@@ -175,10 +181,12 @@ class Rejection(ABCMethod):
     """Rejection sampler.
     """
 
-    def sample(self, n_samples, quantile=0.01, threshold=None):
+    def sample(self, n_samples, quantile=0.01, threshold=None, streaming=False):
         """Run the rejection sampler.
 
-        In quantile mode, the simulator is run (n/quantile) times.
+        In quantile mode, the simulator is run (n/quantile) times. In the streaming
+        quantile mode the batches are processed as they complete and only the best
+        `n_samples` candidates are kept in memory. The result is the same.
 
         In threshold mode, the simulator is run until n_samples can be returned.
         Note that a poorly-chosen threshold may result in a never-ending loop.
@@ -191,6 +199,8 @@ class Rejection(ABCMethod):
             The quantile for determining the acceptance threshold.
         threshold : float, optional
             The acceptance threshold.
+        streaming : bool, optional
+            Use the streaming quantile mode. Default False.
 
         Returns
         -------
@@ -202,7 +212,13 @@ class Rejection(ABCMethod):
 
         parameters = None; distances = None; accepted = None; accept_rate = None
 
-        if threshold is None:
+        if threshold is None and streaming:
+            n_sim = int(np.ceil(n_samples / quantile))
+            distances, parameters = self._acquire_smallest(n_samples, n_sim)
+            threshold = np.max(distances).item()
+            accepted = np.ones(len(distances), dtype=bool)
+            accept_rate = quantile
+        elif threshold is None:
             # Quantile case
             n_sim = int(np.ceil(n_samples / quantile))
             distances, parameters = self._acquire(n_sim)
@@ -214,15 +230,9 @@ class Rejection(ABCMethod):
             accept_rate = quantile
         else:
             # Threshold case
-            n_sim = self._ceil_in_batch_sizes(n_samples)
-            while True:
-                distances, parameters = self._acquire(n_sim)
-                accepted, n_accepted, accept_rate = self.compute_acceptance(distances,
-                                                                            threshold)
-                if n_accepted >= n_samples:
-                    break
-
-                n_sim = self.estimate_proposals_needed(n_samples, accept_rate)
+            distances, parameters, n_sim, accept_rate = \
+                self._acquire_below(n_samples, threshold)
+            accepted = np.ones(len(distances), dtype=bool)
 
         samples = [p[accepted][:n_samples] for p in parameters]
         distances = distances[accepted][:n_samples]
@@ -236,6 +246,96 @@ class Rejection(ABCMethod):
 
         return result
 
+    def _acquire_below(self, n_samples, threshold):
+        """Acquires simulations until `n_samples` distances are below `threshold`.
+
+        Only the new simulations are acquired on each round and only the accepted rows
+        are kept.
+
+        Returns
+        -------
+        distances : np.ndarray
+        parameters : list
+            containing np.ndarray objects of the accepted parameters
+        n_sim : int
+            number of simulations acquired
+        accept_rate : float
+        """
+        distances = []
+        parameters = [[] for p in self.parameter_nodes]
+        n_accepted = 0
+        n_acquired = 0
+        n_sim = self._ceil_in_batch_sizes(n_samples)
+        while True:
+            distances_new, parameters_new = self._acquire(n_sim - n_acquired,
+                                                          starting=n_acquired)
+            accepted = self.accepted(distances_new, threshold)
+            distances.append(distances_new[accepted])
+            for ps, p in zip(parameters, parameters_new):
+                ps.append(p[accepted])
+            n_accepted += np.sum(accepted)
+            n_acquired = n_sim
+            accept_rate = n_accepted / n_sim
+            if n_accepted >= n_samples:
+                break
+
+            n_sim = max(self.estimate_proposals_needed(n_samples, accept_rate),
+                        n_sim + self.batch_size)
+
+        return np.concatenate(distances), [np.concatenate(ps) for ps in parameters], \
+            n_sim, accept_rate
+
+    def _acquire_smallest(self, n_samples, n_sim):
+        """Acquires the `n_samples` smallest of `n_sim` distances and their parameters.
+
+        The batches are computed in parallel and merged as they complete. Ties are
+        resolved in the order of the simulations.
+
+        Returns
+        -------
+        distances : np.ndarray
+        parameters: list
+            containing np.ndarray objects of shapes (n_samples, ...)
+        Both are in the order of the simulations.
+        """
+        logger.info("{}: Running with {} proposals in streaming mode."
+                    .format(self.__class__.__name__, n_sim))
+        # Create the outputs of all the batches
+        self.distance_node.acquire(n_sim, batch_size=self.batch_size)
+        for p in self.parameter_nodes:
+            p.acquire(n_sim, batch_size=self.batch_size)
+
+        batch_starts = list(range(0, n_sim, self.batch_size))[::-1]
+        n_parallel = 2 * self.ncores
+        futures = []
+        indices = np.zeros(0, dtype=int)
+        distances = None
+        parameters = None
+        while len(batch_starts) > 0 or len(futures) > 0:
+            while len(batch_starts) > 0 and len(futures) < n_parallel:
+                start = batch_starts.pop()
+                sl = slice(start, min(start + self.batch_size, n_sim))
+                batch = [start, self.distance_node[sl]] + \
+                    [p[sl] for p in self.parameter_nodes]
+                futures.append(elfi_client().compute(dask.delayed(batch)))
+            batch, _, futures = wait(futures)
+            start, distances_batch, parameters_batch = batch[0], batch[1], batch[2:]
+
+            # Merge the batch with the current candidates
+            indices = np.concatenate((indices,
+                                      np.arange(start, start + len(distances_batch))))
+            if distances is not None:
+                distances_batch = np.concatenate((distances, distances_batch))
+                parameters_batch = [np.concatenate(ps)
+                                    for ps in zip(parameters, parameters_batch)]
+            best = np.lexsort((indices, distances_batch[:, 0]))[:n_samples]
+            indices = indices[best]
+            distances = distances_batch[best]
+            parameters = [p[best] for p in parameters_batch]
+
+        order = np.argsort(indices)
+        return distances[order], [p[order] for p in parameters]
+
     def reject(self, threshold, n_sim=None):
         """Return samples below rejection threshold.
 
@@ -284,6 +384,86 @@ def smc_prior_transform(input_dict, column_interval, prior):
     return core.to_output_dict(input_dict, data=data, pdf=pdf)
 
 
+def smc_batch_weights(distances, parameter_outputs, threshold, proposal):
+    """Selects the accepted simulations of an SMC batch and computes their weights.
+
+    Parameters
+    ----------
+    distances : np.ndarray
+    parameter_outputs : list of dict
+        output dicts of the parameter nodes (see `smc_prior_transform`)
+    threshold : float
+    proposal : SMCProposal
+
+    Returns
+    -------
+    dict
+        "distances" : accepted distances
+        "samples" : accepted parameters in columns
+        "weights" : importance weights of the accepted parameters
+        "prior_pdf" : prior density of the accepted parameters
+        "n_sim" : number of simulations in the batch
+    """
+    accepted = ABCMethod.accepted(distances, threshold)
+    samples = np.hstack([p['data'][accepted] for p in parameter_outputs])
+    prior_pdf = np.prod([p['pdf'][accepted] for p in parameter_outputs], axis=0)
+    return {
+        "distances": distances[accepted],
+        "samples": samples,
+        "weights": prior_pdf / proposal.pdf(samples),
+        "prior_pdf": prior_pdf,
+        "n_sim": len(distances),
+    }
+
+
+def smc_mis_weights(sources, n_samples):
+    """Combines accepted particles drawn from several SMC proposals.
+
+    The particles are taken from the sources in order until there are `n_samples` of
+    them. They are weighted with multiple importance sampling using the balance
+    heuristic: the proposal density is the mixture of the source proposals, each
+    weighted by the number of simulations behind the particles taken from it.
+
+    Parameters
+    ----------
+    sources : list of dict
+        "samples" : accepted parameters in columns
+        "distances" : accepted distances
+        "prior_pdf" : prior density of the accepted parameters
+        "proposal" : the distribution the parameters were drawn from, or None for
+            the prior
+        "n_sim" : number of simulations the particles were accepted from
+    n_samples : int
+
+    Returns
+    -------
+    samples : np.ndarray
+    distances : np.ndarray
+    weights : np.ndarray
+    prior_pdf : np.ndarray
+    """
+    taken = []
+    n_left = n_samples
+    for source in sources:
+        n = min(n_left, len(source['distances']))
+        if n > 0:
+            taken.append((source, n))
+            n_left -= n
+
+    samples = np.vstack([source['samples'][:n] for source, n in taken])
+    distances = np.vstack([source['distances'][:n] for source, n in taken])
+    prior_pdf = np.concatenate([source['prior_pdf'][:n] for source, n in taken])
+    mixture = 0
+    for source, n in taken:
+        n_sim = source['n_sim'] * n / len(source['distances'])
+        if source['proposal'] is None:
+            density = prior_pdf
+        else:
+            density = source['proposal'].pdf(samples)
+        mixture = mixture + n_sim * density
+    return samples, distances, prior_pdf / mixture, prior_pdf
+
+
 class SMC(ABCMethod):
     """Likelihood-free sequential Monte Carlo sampler.
 
@@ -299,23 +479,46 @@ class SMC(ABCMethod):
     """
 
     def __init__(self, *args, **kwargs):
-        self.distance_futures = []
-        self.parameter_futures = []
+        self.batch_futures = []
         self.batch_indexes = []
         self._batches_count = 0
         super(SMC, self).__init__(*args, **kwargs)
 
-    def sample(self, n_samples, n_populations, schedule):
+    def sample(self, n_samples, n_populations, schedule=None, quantile=0.5,
+               min_accept_rate=None, max_sim=None, recycle=False, kernel='global'):
         """Run SMC-ABC sampler.
 
+        If `schedule` is not given, the thresholds are chosen adaptively. The first
+        population is sampled with `Rejection` in quantile mode and each following
+        threshold is the `quantile` of the distances of the previous population.
+
+        The sampling stops before `n_populations` if the accept rate of a population
+        drops below `min_accept_rate` or if `max_sim` simulations have been run.
+
+        With `recycle`, the particles simulated for the earlier populations that pass
+        the current threshold are reused. The proposal of the first population is the
+        prior. Only the shortfall is simulated and the particles are weighted with
+        `smc_mis_weights`.
+
         Parameters
         ----------
         n_samples : int
             Number of samples drawn from the posterior.
         n_populations : int
-            Number of particle populations to iterate over.
-        schedule : iterable of floats
+            (Maximum) number of particle populations to iterate over.
+        schedule : iterable of floats, optional
             Thresholds for particle populations.
+        quantile : float in range ]0, 1], optional
+            The quantile for the adaptive thresholds.
+        min_accept_rate : float, optional
+            Do not start a new population if the accept rate falls below this.
+        max_sim : int, optional
+            Do not start a new population after this many simulations.
+        recycle : bool, optional
+            Reuse the simulations of earlier populations.
+        kernel : str, optional
+            The perturbation kernel of the proposal, see `SMCProposal`. The "olcm"
+            kernel is computed from the particles that pass the next threshold.
 
         Returns
         -------
@@ -325,7 +528,10 @@ class SMC(ABCMethod):
         # Run first round with standard rejection sampling
         logger.info("SMC initialization with Rejection sampling")
         rej = Rejection(self.distance_node, self.parameter_nodes, batch_size=self.batch_size)
-        result = rej.sample(n_samples, threshold=schedule[0])
+        if schedule is None:
+            result = rej.sample(n_samples, quantile=quantile)
+        else:
+            result = rej.sample(n_samples, threshold=schedule[0])
         samples = result.samples_list
         distances = result.distances
         accept_rate = result.accept_rate
@@ -334,7 +540,7 @@ class SMC(ABCMethod):
         weights = [1]*n_samples
 
         # Build the SMC proposal
-        q = SMCProposal(np.hstack(samples), weights)
+        q = SMCProposal(np.hstack(samples), weights, kernel=kernel)
         qnode = Prior("smc_proposal", q,
                       size=(q.size),
                       inference_task=self.distance_node.inference_task)
@@ -347,20 +553,37 @@ class SMC(ABCMethod):
                                 column_interval=i, prior=p.distribution)
             p.set_transform(transform)
 
+        # The simulated particles of each population for recycling
+        sources = []
+        if recycle:
+            sources.append({
+                "samples": np.hstack(samples),
+                "distances": distances.copy(),
+                "prior_pdf": self._prior_pdf(qnode, np.hstack(samples)),
+                "proposal": None,
+                "n_sim": n_sim,
+            })
+
         # TODO: remove this once core allows starting from non zero index
         for node in qnode.component:
             node.reset(propagate=False)
 
         samples_history = []; distances_history = []; threshold_history = []
         weights_history = []; accept_rate_history = []; n_sim_history = []
+        n_sim_saved_history = []
+        n_sim_total = n_sim
 
         # Start iterations
         for t in range(1, n_populations):
-            logger.info("SMC starting iteration {}".format(t))
-            # Update the proposal
-            if t > 1:
-                q.set_population(np.hstack(samples), weights)
+            if min_accept_rate is not None and accept_rate < min_accept_rate:
+                logger.info("SMC stopping: accept rate {:.3g} is below {}"
+                            .format(accept_rate, min_accept_rate))
+                break
+            if max_sim is not None and n_sim_total >= max_sim:
+                logger.info("SMC stopping: simulation budget {} used".format(max_sim))
+                break
 
+            logger.info("SMC starting iteration {}".format(t))
             samples_history.append([s.copy() for s in samples])
             distances_history.append(distances.copy())
             threshold_history.append(threshold)
@@ -368,65 +591,113 @@ class SMC(ABCMethod):
             accept_rate_history.append(accept_rate)
             n_sim_history.append(n_sim)
 
-            threshold = schedule[t]
-            n_accepts_in_sample = np.sum(self.accepted(distances_history[-1], threshold))
-            # Heuristic estimate for the new accept rate
-            accept_rate = np.mean([n_accepts_in_sample/n_sim_history[-1], accept_rate])
+            if schedule is None:
+                threshold = np.percentile(distances, quantile*100)
+            else:
+                threshold = schedule[t]
+
+            # Update the proposal
+            if t > 1 or kernel == 'olcm':
+                q.set_population(np.hstack(samples), weights,
+                                 reference=self.accepted(distances, threshold))
+                # The proposal has changed in place
+                qnode.clear_static_payloads()
+                qnode.clear_structure_token()
+
+            if n_sim_history[-1] > 0:
+                n_accepts_in_sample = np.sum(self.accepted(distances_history[-1],
+                                                           threshold))
+                # Heuristic estimate for the new accept rate
+                accept_rate = np.mean([n_accepts_in_sample/n_sim_history[-1],
+                                       accept_rate])
             n_accepts = 0
             n_sim = 0
+            n_sim_saved = 0
+
+            # The newest particles are used first
+            recycled = [self._passing(source, threshold) for source in reversed(sources)]
+            n_new = max(0, n_samples - sum(len(r['distances']) for r in recycled))
+            if recycled:
+                logger.info("SMC population {} recycled {} particles"
+                            .format(t, n_samples - n_new))
 
             self._batches_count = 0
             samples_t = [[] for p in self.parameter_nodes]
             distances_t = []
             weights_t = []
+            prior_pdf_t = []
+
+            # The weights are computed in the batch tasks
+            proposal = qnode._static_payload('proposal', q)
 
-            # Start adding batches until n_samples is achieved
-            while True:
-                n_add = self._add_new_batches(n_samples, n_accepts, accept_rate)
+            # Start adding batches until n_new is achieved
+            while n_new > 0:
+                n_add = self._add_new_batches(n_new, n_accepts, accept_rate,
+                                              threshold, proposal)
                 # Fill the lists with Nones
                 for l in samples_t:
                     l += [None]*n_add
                 distances_t += [None]*n_add
                 weights_t += [None]*n_add
+                prior_pdf_t += [None]*n_add
 
-                wait(self.distance_futures)
+                wait(self.batch_futures)
 
                 # Iterate over all finished futures
                 while True:
-                    distances_batch, i_future = next_result(self.distance_futures)
+                    batch, i_future = next_result(self.batch_futures)
                     if i_future is None:
                         break
 
-                    p_futures_batch = self.parameter_futures.pop(i_future)
                     batch_index = self.batch_indexes.pop(i_future)
-
-                    accepted_new = self.accepted(distances_batch, threshold)
-                    n_new = np.sum(accepted_new)
-
-                    new_prior_pdf = np.ones(n_new)
-                    new_samples = np.zeros((n_new, q.size[0]))
-
-                    for p_index, p_out in enumerate(p_futures_batch):
-                        p_out = p_out.result()
-                        new_samples[:, p_index:p_index+1] = p_out['data'][accepted_new]
-                        new_prior_pdf *= p_out['pdf'][accepted_new]
-                        samples_t[p_index][batch_index] = new_samples[:, p_index:p_index+1]
-
-                    distances_t[batch_index] = distances_batch[accepted_new]
-                    weights_t[batch_index] = new_prior_pdf / q.pdf(new_samples)
-
-                    n_accepts += n_new
-                    n_sim += len(accepted_new)
+                    for p_index in range(len(self.parameter_nodes)):
+                        samples_t[p_index][batch_index] = \
+                            batch['samples'][:, p_index:p_index+1]
+                    distances_t[batch_index] = batch['distances']
+                    weights_t[batch_index] = batch['weights']
+                    prior_pdf_t[batch_index] = batch['prior_pdf']
+
+                    n_accepts += len(batch['distances'])
+                    n_sim += batch['n_sim']
                     accept_rate = n_accepts / n_sim
 
-                if n_samples <= n_accepts and len(self.distance_futures) == 0:
+                # The population is complete when the batches preceding the
+                # outstanding ones hold enough accepted samples
+                if n_new <= self._n_accepted_in_order(distances_t):
+                    n_sim_saved = self._cancel_batches()
+                    logger.info("SMC population {} cancelled {} surplus simulations"
+                                .format(t, n_sim_saved))
                     break
 
+            n_sim_saved_history.append(n_sim_saved)
+            # Skip the cancelled batches
+            distances_t = [d for d in distances_t if d is not None]
+            weights_t = [w for w in weights_t if w is not None]
+            prior_pdf_t = [pdf for pdf in prior_pdf_t if pdf is not None]
+            samples_t = [[s for s in l if s is not None] for l in samples_t]
+
+            if recycle:
+                if n_new > 0:
+                    sources.append({
+                        "samples": np.hstack([np.vstack(l) for l in samples_t]),
+                        "distances": np.vstack(distances_t),
+                        "prior_pdf": np.concatenate(prior_pdf_t),
+                        "proposal": copy.copy(q),
+                        "n_sim": n_sim,
+                    })
+                    recycled.append(sources[-1])
+                samples_t, distances_t, weights_t, _ = smc_mis_weights(recycled,
+                                                                       n_samples)
+                samples_t = [[samples_t[:, i:i+1]] for i in range(len(samples))]
+                distances_t = [distances_t]
+                weights_t = [weights_t]
+
             for i_p, p in enumerate(samples):
                 p[:] = np.vstack(samples_t[i_p])[:n_samples]
             distances[:] = np.vstack(distances_t)[:n_samples]
             # TODO: make weights 2d as well
             weights[:] = np.concatenate(weights_t)[:n_samples]
+            n_sim_total += n_sim
 
         result = Result_SMC(samples_list=samples,
                             nodes=self.parameter_nodes,
@@ -435,19 +706,29 @@ class SMC(ABCMethod):
                             threshold=threshold,
                             n_sim=n_sim,
                             accept_rate=accept_rate,
-                            n_populations=n_populations,
+                            n_populations=len(threshold_history) + 1,
+                            n_sim_total=n_sim_total,
                             samples_history=samples_history,
                             distances_history=distances_history,
                             weights_history=weights_history,
                             threshold_history=threshold_history,
-                            accept_rate_history=accept_rate_history)
+                            accept_rate_history=accept_rate_history,
+                            n_sim_saved_history=n_sim_saved_history)
 
         return result
 
-    def _add_new_batches(self, n_samples, n_accepted, accept_rate):
+    def _add_new_batches(self, n_samples, n_accepted, accept_rate, threshold, proposal):
+        """Adds batches that select the accepted simulations and compute their
+        weights (see `smc_batch_weights`).
+
+        Returns
+        -------
+        n_add : int
+            number of batches added
+        """
         n_left = n_samples - n_accepted
         n_batches = self.estimate_batches_needed(n_left, accept_rate)
-        n_add = max(0, n_batches - len(self.distance_futures))
+        n_add = max(0, n_batches - len(self.batch_futures))
 
         for i_batch in range(n_add):
             logger.info("SMC generating a batch of {} ({}/{})".format(self.batch_size,
@@ -456,14 +737,66 @@ class SMC(ABCMethod):
             # TODO: self.distance_node.create_delayed_output(self.batch_size)
             d = self.distance_node.generate(self.batch_size)
             p = [pn.get_delayed_output(d) for pn in self.parameter_nodes]
-            futures = elfi_client().compute([d]+p)
-            self.distance_futures.append(futures[0])
-            self.parameter_futures.append(futures[1:])
+            key = utils.reset_key_id(d.key, self.distance_node.id + '/smc_weights')
+            batch = utils.keyed_delayed(key, smc_batch_weights, d, p, threshold,
+                                        proposal)
+            self.batch_futures.append(elfi_client().compute(batch))
             self.batch_indexes.append(self._batches_count)
             self._batches_count += 1
 
         return n_add
 
+    def _prior_pdf(self, qnode, samples):
+        """Computes the prior density of `samples` with the parameter nodes.
+
+        Generates outputs of the parameter nodes, so the nodes must be reset before
+        sampling.
+        """
+        outputs = []
+        for p in self.parameter_nodes:
+            p.generate(len(samples), with_values={qnode.name: samples})
+            outputs.append(p.get_delayed_output(0))
+        outputs = dask.compute(*outputs)
+        return np.prod([o['pdf'] for o in outputs], axis=0)
+
+    def _passing(self, source, threshold):
+        """Selects the particles of a recycling source that pass the threshold.
+
+        The number of simulations stays that of the whole source.
+        """
+        accepted = self.accepted(source['distances'], threshold)
+        passing = dict(source)
+        for k in ('samples', 'distances', 'prior_pdf'):
+            passing[k] = source[k][accepted]
+        return passing
+
+    @staticmethod
+    def _n_accepted_in_order(distances_t):
+        """Number of accepted samples in the finished batches that precede the
+        first unfinished one.
+        """
+        n = 0
+        for d in distances_t:
+            if d is None:
+                break
+            n += len(d)
+        return n
+
+    def _cancel_batches(self):
+        """Cancels the outstanding batches.
+
+        Returns
+        -------
+        n_sim_saved : int
+            number of simulations in the cancelled batches
+        """
+        n_sim_saved = len(self.batch_futures) * self.batch_size
+        if self.batch_futures:
+            elfi_client().cancel(self.batch_futures)
+        self.batch_futures = []
+        self.batch_indexes = []
+        return n_sim_saved
+
 
 class BolfiAcquisition(SecondDerivativeNoiseMixin, LCBAcquisition):
     """Default acquisition function for BOLFI.
@@ -562,6 +895,43 @@ class BOLFI(ABCMethod):
         self.create_surrogate_likelihood()
         return self.get_posterior(threshold)
 
+    def sample(self, n_samples, threshold=None, n_chains=20, burn_in=100, thin=1,
+               seed=None):
+        """Samples the BOLFI posterior with MCMC.
+
+        Fits the surrogate model first if it is not yet finished. The chains are
+        run with `BolfiPosterior.sample_mcmc`.
+
+        Parameters
+        ----------
+        n_samples : int
+            Number of samples from the posterior.
+        threshold : float, optional
+            See get_posterior.
+        n_chains : int, optional
+        burn_in : int, optional
+        thin : int, optional
+        seed : int, optional
+
+        Returns
+        -------
+        result : instance of elfi.Result
+        """
+        self.create_surrogate_likelihood()
+        posterior = self.get_posterior(threshold)
+        samples, accept_rate = posterior.sample_mcmc(n_samples, n_chains=n_chains,
+                                                     burn_in=burn_in, thin=thin,
+                                                     seed=seed)
+        samples_list = [samples[:, i:i+1] for i in range(self.n_dimensions)]
+        result = Result(samples_list=samples_list,
+                        nodes=self.parameter_nodes,
+                        threshold=posterior.threshold,
+                        accept_rate=accept_rate,
+                        n_chains=n_chains,
+                        posterior=posterior)
+
+        return result
+
     def create_surrogate_likelihood(self):
         """Samples discrepancy iteratively to fit the surrogate model.
         """
@@ -582,12 +952,12 @@ class BOLFI(ABCMethod):
             if next_batch_size > 0:
                 pending_locations = np.atleast_2d(pending) if len(pending) > 0 else None
                 new_locations = self.acquisition.acquire(next_batch_size, pending_locations)
-                for location in new_locations:
-                    wv_dict = {param.name: np.atleast_2d(location[i])
-                               for i, param in enumerate(self.parameter_nodes)}
-                    future = self.distance_node.generate(1, with_values=wv_dict)
-                    futures.append(future)
-                    pending.append(location)
+                # All the new locations are simulated in one batch
+                wv_dict = {param.name: new_locations[:, i:i+1]
+                           for i, param in enumerate(self.parameter_nodes)}
+                futures.extend(self.distance_node.evaluate_at(wv_dict,
+                                                              client=self.client))
+                pending.extend(new_locations)
             result, result_index, futures = wait(futures, self.client)
             location = pending.pop(result_index)
             logger.debug("{}: Observed {:f} at {}."
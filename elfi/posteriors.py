@@ -5,7 +5,7 @@ import scipy as sp
 import matplotlib
 import matplotlib.pyplot as plt
 
-from .utils import stochastic_optimization
+from .utils import multistart_optimization, latin_hypercube
 
 logger = logging.getLogger(__name__)
 
@@ -83,18 +83,103 @@ class Posterior():
 
 
 class BolfiPosterior(Posterior):
+    """Posterior from the GP surrogate of the discrepancy.
 
-    def __init__(self, model, threshold, priors=None):
+    The threshold (if not given), the ML and the MAP estimates are searched on first
+    access with multi-start L-BFGS-B using the gradients of the GP. The searches
+    start from a Latin hypercube sample and from the evidence points with the
+    smallest discrepancies.
+
+    Parameters
+    ----------
+    model : GPyModel
+    threshold : float or None
+        discrepancy threshold, if None uses the minimum of the GP mean
+    priors : list, optional
+    n_starts : int, optional
+        number of Latin hypercube starting points in the searches
+    n_evidence_starts : int, optional
+        number of evidence points to start the searches from
+    random_state : np.random.RandomState, optional
+    """
+
+    def __init__(self, model, threshold, priors=None, n_starts=10, n_evidence_starts=5,
+                 random_state=None):
         super(BolfiPosterior, self).__init__()
-        self.threshold = threshold
         self.model = model
-        if self.threshold is None:
-            minloc, minval = stochastic_optimization(self.model.eval_mean, self.model.bounds, 10000)
-            self.threshold = minval
-            logger.info("Using minimum value of discrepancy estimate mean (%.4f) as threshold" % (self.threshold))
+        self._threshold = threshold
         self.priors = [None] * model.input_dim
-        self.ML, self.ML_val = stochastic_optimization(self._neg_unnormalized_loglikelihood_density, self.model.bounds, 10000)
-        self.MAP, self.MAP_val = stochastic_optimization(self._neg_unnormalized_logposterior_density, self.model.bounds, 10000)
+        self.n_starts = n_starts
+        self.n_evidence_starts = n_evidence_starts
+        self.random_state = random_state
+        self._ML = None
+        self._MAP = None
+
+    @property
+    def threshold(self):
+        if self._threshold is None:
+            minloc, self._threshold = self._minimize(self._mean_and_gradient)
+            logger.info("Using minimum value of discrepancy estimate mean (%.4f) "
+                        "as threshold" % (self._threshold))
+        return self._threshold
+
+    @property
+    def ML(self):
+        return self._get_ML()[0]
+
+    @property
+    def ML_val(self):
+        return self._get_ML()[1]
+
+    @property
+    def MAP(self):
+        return self._get_MAP()[0]
+
+    @property
+    def MAP_val(self):
+        return self._get_MAP()[1]
+
+    def _get_ML(self):
+        if self._ML is None:
+            self._ML = self._minimize(self._neg_loglikelihood_and_gradient)
+        return self._ML
+
+    def _get_MAP(self):
+        if self._MAP is None:
+            if all(prior is None for prior in self.priors):
+                self._MAP = self._get_ML()
+            else:
+                # No gradients for the priors
+                self._MAP = self._minimize(self._neg_unnormalized_logposterior_density,
+                                           jac=False)
+        return self._MAP
+
+    def _minimize(self, fun, jac=True):
+        """Minimizes `fun` within the model bounds (see `multistart_optimization`)."""
+        initial = None
+        if self.model.n_observations > 0:
+            best = np.argsort(self.model.Y[:, 0])[:self.n_evidence_starts]
+            initial = self.model.X[best]
+        return multistart_optimization(fun, self.model.bounds, n_starts=self.n_starts,
+                                       initial=initial, jac=jac,
+                                       random_state=self.random_state)
+
+    def _mean_and_gradient(self, x):
+        x = np.atleast_2d(x)
+        mean, var = self.model.evaluate_batch(x)
+        d_mean, d_var = self.model.evaluate_gradients(x)
+        return mean[0], d_mean[0]
+
+    def _neg_loglikelihood_and_gradient(self, x):
+        """Returns -log Phi((threshold - mean) / std) and its gradient at x."""
+        x = np.atleast_2d(x)
+        mean, var = self.model.evaluate_batch(x)
+        d_mean, d_var = self.model.evaluate_gradients(x)
+        std = np.sqrt(max(var[0], 1e-12))
+        z = (self.threshold - mean[0]) / std
+        logcdf = sp.stats.norm.logcdf(z)
+        d_z = -d_mean[0] / std - z * d_var[0] / (2*std**2)
+        return -logcdf, -np.exp(sp.stats.norm.logpdf(z) - logcdf) * d_z
 
     def logpdf(self, x, norm=False):
         if norm is True:
@@ -115,6 +200,87 @@ class BolfiPosterior(Posterior):
             raise ValueError("Unable to evaluate model at %s" % (x))
         return sp.stats.norm.logcdf(self.threshold, mean, std)
 
+    def _unnormalized_loglikelihood_density_batch(self, X):
+        """Evaluates the unnormalized log likelihood at the rows of X."""
+        mean, var = self.model.evaluate_batch(X)
+        return sp.stats.norm.logcdf(self.threshold, mean, np.sqrt(var))
+
+    def _unnormalized_logposterior_density_batch(self, X):
+        """Evaluates the unnormalized log posterior at the rows of X."""
+        logprior = np.array([self._logprior_density(x) for x in X])
+        return self._unnormalized_loglikelihood_density_batch(X) + logprior
+
+    def sample_mcmc(self, n_samples, n_chains=20, burn_in=100, thin=1, stretch=2.,
+                    seed=None):
+        """Samples the posterior with the affine invariant ensemble sampler.
+
+        All the chains are moved with the stretch move of Goodman & Weare (2010).
+        The log posterior of each half of the chains is evaluated with one batch
+        prediction of the GP. The chains start from a Latin hypercube sample within
+        the model bounds, where the posterior is defined.
+
+        Parameters
+        ----------
+        n_samples : int
+            number of samples to return
+        n_chains : int, optional
+            number of chains, at least twice the input dimension
+        burn_in : int, optional
+            number of initial iterations to discard
+        thin : int, optional
+            keep every `thin`th iteration
+        stretch : float, optional
+            scale parameter of the stretch move
+        seed : int, optional
+
+        Returns
+        -------
+        samples : np.ndarray
+            samples in rows, taken from all the chains
+        accept_rate : float
+        """
+        dim = self.model.input_dim
+        if n_chains < 2*dim:
+            raise ValueError("Expected at least {} chains. Received {}."
+                             .format(2*dim, n_chains))
+        random_state = np.random.RandomState(seed)
+        bounds = np.asarray(self.model.bounds, dtype=float)
+
+        def logpdf_batch(X):
+            vals = np.full(len(X), -np.inf)
+            inside = np.all((X >= bounds[:, 0]) & (X <= bounds[:, 1]), axis=1)
+            if np.any(inside):
+                vals[inside] = self._unnormalized_logposterior_density_batch(X[inside])
+            return vals
+
+        chains = bounds[:, 0] + latin_hypercube(n_chains, dim, random_state) * \
+            (bounds[:, 1] - bounds[:, 0])
+        logpdfs = logpdf_batch(chains)
+        halves = (np.arange(n_chains // 2), np.arange(n_chains // 2, n_chains))
+
+        n_iter = burn_in + int(np.ceil(n_samples * thin / n_chains))
+        samples = []
+        n_accepted = 0
+        for i in range(n_iter):
+            for active, other in (halves, halves[::-1]):
+                z = ((stretch - 1) * random_state.rand(len(active)) + 1)**2 / stretch
+                partners = chains[random_state.choice(other, size=len(active))]
+                proposals = partners + z[:, None] * (chains[active] - partners)
+                proposal_logpdfs = logpdf_batch(proposals)
+                with np.errstate(invalid='ignore'):
+                    log_ratio = (dim - 1) * np.log(z) + proposal_logpdfs - \
+                        logpdfs[active]
+                accept = np.log(random_state.rand(len(active))) < log_ratio
+                chains[active[accept]] = proposals[accept]
+                logpdfs[active[accept]] = proposal_logpdfs[accept]
+                if i >= burn_in:
+                    n_accepted += np.sum(accept)
+            if i >= burn_in and (i - burn_in) % thin == 0:
+                samples.append(chains.copy())
+
+        accept_rate = n_accepted / max(1, (n_iter - burn_in) * n_chains)
+        return np.vstack(samples)[:n_samples], accept_rate
+
     def _unnormalized_likelihood_density(self, x):
         return np.exp(self._unnormalized_loglikelihood_density(x))
 
@@ -143,9 +309,9 @@ class BolfiPosterior(Posterior):
             mx = self.model.bounds[0][1]
             dx = (mx - mn) / 200.0
             x = np.arange(mn, mx, dx)
-            pd = np.zeros(len(x))
-            for i in range(len(x)):
-                pd[i] = self.pdf([x[i]], norm)
+            if norm is True:
+                raise NotImplementedError("Normalized posterior not implemented")
+            pd = np.exp(self._unnormalized_logposterior_density_batch(x[:, None]))
             plt.figure()
             plt.plot(x, pd)
             plt.xlim(mn, mx)
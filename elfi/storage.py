@@ -3,10 +3,11 @@
 import logging
 import os
 import random
+import threading
 import time
 import json
 import pickle
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 
 import numpy as np
@@ -63,7 +64,8 @@ class ElfiStore:
 
         Returns
         -------
-        dask.delayed object yielding the data matching the slice with .compute()
+        dask.delayed object yielding the data matching the slice with .compute(), or
+        None if the store no longer has the data
         """
         raise NotImplementedError
 
@@ -167,34 +169,140 @@ Implementations
 """
 
 
+def output_nbytes(output):
+    """Returns the number of bytes in the numpy arrays of the output dict."""
+    return sum(v.nbytes for v in output.values() if isinstance(v, np.ndarray))
+
+
 class MemoryStore(ElfiStore):
-    """Cache results in memory of the workers using dask.distributed."""
-    def __init__(self):
-        self._persisted = defaultdict(lambda: None)
+    """Cache results in memory of the workers using dask.distributed.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Budget for the outputs held in the memory of the workers. When it is exceeded,
+        the least recently read outputs are released or, if `spill_dir` is given,
+        spilled to disk. Released outputs are computed again when needed. Default no
+        limit.
+    spill_dir : str, optional
+        Directory where the data of the evicted outputs is saved as npy files.
+
+    Attributes
+    ----------
+    hits : int
+        Number of `read_data` calls served from memory or disk
+    misses : int
+        Number of `read_data` calls for released outputs
+    evictions : int
+        Number of outputs released or spilled
+    """
+    def __init__(self, max_bytes=None, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        # Persisted outputs in the order of their last use
+        self._persisted = OrderedDict()
+        # The eviction runs in the thread of the client
+        self._lock = threading.Lock()
+        self._evicting = False
+        self._nbytes = {}
+        self._spilled = {}
+        self._released = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def write(self, output, done_callback=None):
         key = output.key
         # Persist key to client
-        d = env.client().persist(output)
-        self._persisted[key] = d
+        client = env.client()
+        d = client.persist(output)
+        with self._lock:
+            self._persisted[key] = d
+            self._released.discard(key)
 
         future = d.dask[key]
         if done_callback is not None:
             future.add_done_callback(lambda f: done_callback(key, f))
+        if self.max_bytes is not None:
+            # The size is computed where the output is held
+            size_future = client.submit(output_nbytes, future)
+            size_future.add_done_callback(lambda f: self._post_size(key, f))
 
     def read(self, key):
+        if key in self._spilled:
+            return {"data": np.load(self._spilled[key])}
         return self._persisted[key].compute()
 
     def read_data(self, node_id, sl):
-        sl = to_slice(sl)
-        # TODO: allow arbitrary slices to be taken, now they have to match
-        output = [d for key, d in self._persisted.items() if get_key_slice(key) == sl]
-        if len(output) == 0:
-            raise IndexError("No matching slice found.")
-        return get_named_item(output[0], 'data')
+        """Returns the delayed data or None if the output has been released."""
+        key = make_key(node_id, to_slice(sl))
+        if key in self._spilled:
+            self.hits += 1
+            data_key = make_key(node_id + "-data", sl)
+            return delayed(np.load, pure=True)(self._spilled[key],
+                                               dask_key_name=data_key)
+        if key in self._released:
+            self.misses += 1
+            return None
+        with self._lock:
+            output = self._persisted.get(key)
+            if output is None:
+                raise IndexError("No matching slice found.")
+            self._persisted.move_to_end(key)
+        self.hits += 1
+        return get_named_item(output, 'data')
 
     def reset(self, node_id):
-        self._persisted.clear()
+        with self._lock:
+            self._persisted.clear()
+        self._nbytes.clear()
+        self._released.clear()
+        for filename in self._spilled.values():
+            _remove(filename)
+        self._spilled.clear()
+
+    @property
+    def nbytes(self):
+        """Number of bytes held in the memory of the workers (of the sized outputs)."""
+        return sum(self._nbytes.values())
+
+    @gen.coroutine
+    def _post_size(self, key, size_future):
+        nbytes = yield size_future._result()
+        if key not in self._persisted:
+            return
+        self._nbytes[key] = nbytes
+        if not self._evicting:
+            self._evicting = True
+            try:
+                yield self._evict()
+            finally:
+                self._evicting = False
+
+    @gen.coroutine
+    def _evict(self):
+        """Evicts the least recently read outputs until the budget is met."""
+        while self.nbytes > self.max_bytes:
+            with self._lock:
+                key = next(k for k in self._persisted if k in self._nbytes)
+                output = self._persisted[key]
+            if self.spill_dir is not None:
+                result = yield output.dask[key]._result()
+                filename = os.path.join(self.spill_dir, "{}-{}-{}.npy".format(*key))
+                np.save(filename, result["data"])
+                if key not in self._nbytes:
+                    # Reset while the data was fetched
+                    _remove(filename)
+                    continue
+                self._spilled[key] = filename
+            else:
+                self._released.add(key)
+            with self._lock:
+                del self._persisted[key]
+            del self._nbytes[key]
+            self.evictions += 1
 
 
 class LocalDataStore(LocalElfiStore):
@@ -232,6 +340,139 @@ class LocalDataStore(LocalElfiStore):
         self._local_store[sl] = output_result["data"]
 
 
+class SimulationCache:
+    """Persistent cache of node outputs on disk.
+
+    The outputs are addressed by content tokens that identify the operation of the
+    node, the outputs of its parents, the random sub stream and the batch slice (see
+    `Transform.get_slice`). Thus the cache can be shared between sessions and
+    inference tasks with the same seed. Set it to use with
+    `elfi.env.set_option(cache=SimulationCache(path))`.
+
+    The files are written by the workers, so the path must be accessible to them.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache. Created if it does not exist.
+    max_size : int, optional
+        Maximum total size of the cached outputs in bytes. The least recently used
+        outputs are removed when the size is exceeded. Default no limit. Each process
+        keeps a running total of the size and lists the directory only when the total
+        exceeds the limit, so outputs saved by other processes are noticed late.
+    """
+    suffix = ".pkl"
+    # Fraction of `max_size` freed below the limit at each eviction, so that the
+    # directory is not listed again at the next save
+    evict_fraction = .1
+
+    def __init__(self, path, max_size=None):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+        self._size = None
+
+    def __contains__(self, token):
+        return os.path.exists(self._filename(token))
+
+    def load(self, token):
+        """Returns the output dict of `token` and marks it as used.
+
+        Parameters
+        ----------
+        token : str
+
+        Returns
+        -------
+        output_dict : dict
+        """
+        filename = self._filename(token)
+        try:
+            with open(filename, 'rb') as f:
+                output = pickle.load(f)
+            os.utime(filename)
+        except FileNotFoundError:
+            raise KeyError("Output {} has been removed from the cache".format(token))
+        return output
+
+    def save(self, token, output):
+        """Saves `output` under `token`. The observed data is not saved.
+
+        Parameters
+        ----------
+        token : str
+        output : dict
+            output dict of a node
+
+        Returns
+        -------
+        output : dict
+            the unmodified output
+        """
+        filename = self._filename(token)
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump({k: v for k, v in output.items() if k != 'observed'}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            n_bytes = f.tell()
+        os.replace(tmp_filename, filename)
+        if self.max_size is not None:
+            if self._size is None:
+                self._size = self.size
+            else:
+                self._size += n_bytes
+            if self._size > self.max_size:
+                self._evict()
+        return output
+
+    def clear(self):
+        """Removes all the outputs from the cache."""
+        for filename, _ in self._entries():
+            _remove(filename)
+        self._size = 0
+
+    @property
+    def size(self):
+        """Total size of the cached outputs in bytes."""
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def _filename(self, token):
+        return os.path.join(self.path, token + self.suffix)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(self.suffix):
+                filename = os.path.join(self.path, name)
+                try:
+                    entries.append((filename, os.stat(filename)))
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    def _evict(self):
+        """Removes the least recently used outputs until the size is
+        `evict_fraction` below the limit.
+        """
+        entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+        size = sum(stat.st_size for _, stat in entries)
+        target = self.max_size*(1 - self.evict_fraction)
+        for filename, stat in entries:
+            if size <= target:
+                break
+            _remove(filename)
+            size -= stat.st_size
+        self._size = size
+
+
+def _remove(filename):
+    """Removes a file that another process may have removed already."""
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
 def _serialize_numpy(data):
     """For simple numpy arrays.
 
@@ -1,10 +1,16 @@
+import hashlib
 import logging
 import operator
+import types
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
+import cloudpickle
 import numpy as np
-from dask.delayed import delayed
+import scipy.stats as ss
+from dask.delayed import delayed, Delayed
 
-from scipy.optimize import differential_evolution
+from scipy.optimize import differential_evolution, minimize
 
 logger = logging.getLogger(__name__)
 
@@ -96,7 +102,165 @@ def get_named_item(output, item, name=None):
     name = name or item
     new_key_name = get_key_id(output.key) + '/' + str(name)
     new_key = reset_key_id(output.key, new_key_name)
-    return delayed(operator.getitem)(output, item, dask_key_name=new_key)
+    return keyed_delayed(new_key, operator.getitem, output, item)
+
+
+def keyed_delayed(key, func, *args):
+    """Makes a delayed call `func(*args)` with an explicit key.
+
+    Works like `dask.delayed(func)(*args, dask_key_name=key)`, but builds the task
+    directly: nothing is tokenized and only lists, tuples and dicts are searched for
+    delayed arguments. Relies on `Delayed` holding a list of graphs, as it does
+    before dask 0.14 (see setup.py).
+
+    Parameters
+    ----------
+    key : hashable
+        key of the task, e.g. an ELFI key from `make_key`
+    func : callable
+    *args
+        arguments of the call, possibly delayed objects
+
+    Returns
+    -------
+    dask.delayed object
+    """
+    dependencies = []
+    task = (func, ) + tuple(_to_task(arg, dependencies) for arg in args)
+    dasks = [{key: task}]
+    if len(dependencies) == 1:
+        dasks += dependencies[0]._dasks
+    else:
+        seen = set()
+        for d in dependencies:
+            for dsk in d._dasks:
+                if id(dsk) not in seen:
+                    seen.add(id(dsk))
+                    dasks.append(dsk)
+    return Delayed(key, dasks)
+
+
+def _to_task(obj, dependencies):
+    """Replaces the delayed objects in `obj` with their keys and collects them to
+    `dependencies`."""
+    typ = type(obj)
+    if isinstance(obj, Delayed):
+        dependencies.append(obj)
+        return obj.key
+    elif typ is list:
+        return [_to_task(o, dependencies) for o in obj]
+    elif typ is tuple:
+        return (tuple, [_to_task(o, dependencies) for o in obj])
+    elif typ is dict:
+        return (dict, [[k, _to_task(v, dependencies)] for k, v in obj.items()])
+    return obj
+
+
+def make_token(*parts):
+    """Returns a hash of `parts` that is stable across sessions.
+
+    Python functions are identified by their name, code and default arguments, the
+    values of their closures and the global variables they refer to, including
+    functions nested in partials. Scipy distributions are identified by their class
+    and parameters, leaving out their random state. Other objects are identified by
+    their pickled content.
+
+    Notes
+    -----
+    Of the global variables, only constants (numbers, strings, arrays and tuples),
+    scipy distributions and functions of the same module are part of the token. Other
+    functions are identified by their name only. Mutable containers such as lists are
+    left out.
+
+    Returns
+    -------
+    str
+    """
+    return hashlib.sha1(cloudpickle.dumps(_normalize_token(parts))).hexdigest()
+
+
+def _normalize_token(obj, seen=None):
+    """Returns a picklable form of `obj` whose pickle does not vary between sessions.
+
+    `seen` holds the ids of the functions being normalized, so that recursive
+    references are replaced with the names of the functions.
+    """
+    seen = set() if seen is None else seen
+    typ = type(obj)
+    if typ in (list, tuple):
+        return typ(_normalize_token(o, seen) for o in obj)
+    elif typ is dict:
+        items = [(k, _normalize_token(v, seen)) for k, v in obj.items()]
+        return sorted(items, key=lambda i: i[0])
+    elif isinstance(obj, partial):
+        return ('partial', _normalize_token(obj.func, seen),
+                _normalize_token(obj.args, seen),
+                _normalize_token(obj.keywords or {}, seen))
+    elif isinstance(obj, types.FunctionType):
+        return _normalize_function(obj, seen)
+    elif isinstance(obj, types.ModuleType):
+        return ('module', obj.__name__)
+    elif isinstance(obj, (ss.rv_continuous, ss.rv_discrete)):
+        return _normalize_scipy_distribution(obj, seen)
+    elif isinstance(getattr(obj, 'dist', None), (ss.rv_continuous, ss.rv_discrete)):
+        # Frozen scipy distribution
+        return ('frozen', _normalize_token(obj.dist, seen),
+                _normalize_token(obj.args, seen), _normalize_token(obj.kwds, seen))
+    return obj
+
+
+def _normalize_function(func, seen):
+    name = ('function', func.__module__, func.__qualname__)
+    if id(func) in seen:
+        return name
+    seen.add(id(func))
+    closure = [c.cell_contents for c in func.__closure__ or ()]
+    global_values = {}
+    for n in _code_names(func.__code__):
+        value = func.__globals__.get(n)
+        if isinstance(value, types.FunctionType) and value.__module__ != func.__module__:
+            global_values[n] = ('function', value.__module__, value.__qualname__)
+        elif isinstance(value, _global_types):
+            global_values[n] = value
+    normalized = name + (_normalize_code(func.__code__),
+                         _normalize_token(func.__defaults__ or (), seen),
+                         _normalize_token(func.__kwdefaults__ or {}, seen),
+                         _normalize_token(closure, seen),
+                         _normalize_token(global_values, seen))
+    seen.discard(id(func))
+    return normalized
+
+
+# Types of the global variables that are part of the tokens of functions
+_global_types = (types.FunctionType, partial, ss.rv_continuous, ss.rv_discrete,
+                 np.ndarray, np.generic, int, float, complex, str, bytes, bool, tuple)
+
+
+def _normalize_code(code):
+    consts = tuple(_normalize_code(c) if isinstance(c, types.CodeType) else c
+                   for c in code.co_consts)
+    return code.co_code, consts, code.co_names
+
+
+def _code_names(code):
+    """Names referred to by `code` and the code nested in it."""
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names |= _code_names(c)
+    return names
+
+
+def _normalize_scipy_distribution(dist, seen):
+    """Identifies a scipy distribution by its class, the methods defined in the class
+    and its parameters. The random state is left out.
+    """
+    typ = type(dist)
+    methods = {k: v for k, v in vars(typ).items() if isinstance(v, types.FunctionType)}
+    params = {k: v for k, v in vars(dist).items()
+              if k not in ('_random_state', '_ctor_param') and not callable(v)}
+    return ('scipy', typ.__module__, typ.__qualname__, _normalize_token(methods, seen),
+            _normalize_token(params, seen))
 
 
 def to_slice(item):
@@ -131,6 +295,49 @@ def slen(sl):
     return sl.stop - sl.start
 
 
+def stack_slices(data_list, slices=None):
+    """Stacks the slices of the arrays in `data_list` along the first axis.
+
+    The output is allocated once and each slice is copied straight into place,
+    so that no intermediate stacked arrays are created.
+
+    Parameters
+    ----------
+    data_list : list of np.ndarray
+        Arrays with matching trailing dimensions.
+    slices : list of slice or None, optional
+        Slice to take from each array. None takes the whole array.
+
+    Returns
+    -------
+    np.ndarray
+
+    Examples
+    --------
+    >>> stack_slices([np.zeros((2, 1), dtype=int), np.ones((3, 1), dtype=int)],
+    ...              [slice(1, 2), None])
+    array([[0],
+           [1],
+           [1],
+           [1]])
+    """
+    slices = slices or [None] * len(data_list)
+    pieces = [d if sl is None else d[sl] for d, sl in zip(data_list, slices)]
+    trailing_shape = pieces[0].shape[1:]
+    for p in pieces:
+        if p.shape[1:] != trailing_shape:
+            raise ValueError("All the stacked arrays must have matching trailing "
+                             "dimensions")
+
+    n = sum(len(p) for p in pieces)
+    output = np.empty((n, ) + trailing_shape, dtype=np.result_type(*pieces))
+    i = 0
+    for p in pieces:
+        output[i:i + len(p)] = p
+        i += len(p)
+    return output
+
+
 def atleast_2d(data):
     """Translates data into at least 2d format used by the core.
 
@@ -217,10 +424,257 @@ def weighted_cov(x, weights):
     return a*cov
 
 
-def stochastic_optimization(fun, bounds, its, polish=False):
-    """ Called to find the minimum of function 'fun' in 'its' iterations """
-    result = differential_evolution(func=fun, bounds=bounds, maxiter=its,
-                                    popsize=30, tol=0.01, mutation=(0.5, 1),
-                                    recombination=0.7, disp=False,
-                                    polish=polish, init='latinhypercube')
-    return result.x, result.fun
+def stochastic_optimization(fun, bounds, its, polish=False, vectorized=False,
+                            workers=None, random_state=None):
+    """Finds the minimum of function `fun` with differential evolution.
+
+    By default each candidate is evaluated with its own call. With `vectorized` or
+    `workers`, each generation is evaluated at once (see `_differential_evolution`).
+
+    Parameters
+    ----------
+    fun : callable
+        Objective function. With `vectorized`, takes the candidates in the rows of a
+        2d array and returns their values in a 1d array.
+    bounds : tuple of (min, max) tuples
+    its : int
+        Maximum number of generations.
+    polish : bool, optional
+        Finish with L-BFGS-B from the best candidate.
+    vectorized : bool, optional
+    workers : int, optional
+        Number of threads to split each generation to.
+    random_state : np.random.RandomState, optional
+
+    Returns
+    -------
+    tuple
+        location and value of the minimum
+    """
+    if not vectorized and workers is None:
+        result = differential_evolution(func=fun, bounds=bounds, maxiter=its,
+                                        popsize=30, tol=0.01, mutation=(0.5, 1),
+                                        recombination=0.7, disp=False,
+                                        polish=polish, init='latinhypercube',
+                                        seed=random_state)
+        return result.x, result.fun
+
+    if vectorized:
+        fun_batch = fun
+    else:
+        fun_batch = lambda X: np.array([fun(x) for x in X])
+    executor = None
+    if workers is not None and workers > 1:
+        # The threads are shared by all the generations
+        executor = ThreadPoolExecutor(max_workers=workers)
+        fun_batch = partial(_map_batches, fun_batch, executor=executor,
+                            n_parts=workers)
+
+    try:
+        x, val = _differential_evolution(fun_batch, bounds, its,
+                                         random_state=random_state)
+        if polish:
+            result = minimize(lambda x: float(np.ravel(fun_batch(x[None, :]))[0]), x,
+                              method='L-BFGS-B', bounds=bounds)
+            if result.fun < val:
+                x, val = result.x, float(result.fun)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return x, val
+
+
+def multistart_optimization(fun, bounds, n_starts=10, initial=None, jac=True,
+                           random_state=None):
+    """Finds the minimum of function `fun` with L-BFGS-B from several starting points.
+
+    The starting points are a Latin hypercube sample within the bounds and the rows of
+    `initial`.
+
+    Parameters
+    ----------
+    fun : callable
+        Objective function of a 1d location. If `jac` is True, returns also the
+        gradient.
+    bounds : tuple of (min, max) tuples
+    n_starts : int, optional
+        Number of the Latin hypercube starting points.
+    initial : np.ndarray, optional
+        Additional starting points in rows.
+    jac : bool, optional
+    random_state : np.random.RandomState, optional
+
+    Returns
+    -------
+    tuple
+        location and value of the minimum
+    """
+    bounds_ = np.asarray(bounds, dtype=float)
+    low, scale = bounds_[:, 0], bounds_[:, 1] - bounds_[:, 0]
+    starts = low + latin_hypercube(n_starts, len(bounds), random_state)*scale
+    if initial is not None and len(initial) > 0:
+        starts = np.vstack((np.atleast_2d(initial), starts))
+
+    best_x, best_val = None, np.inf
+    for x0 in starts:
+        result = minimize(fun, x0, jac=jac, method='L-BFGS-B', bounds=bounds)
+        if best_x is None or result.fun < best_val:
+            best_x, best_val = result.x, float(result.fun)
+    return best_x, best_val
+
+
+def latin_hypercube(n, dim, random_state=None):
+    """Returns a Latin hypercube sample of `n` points in the `dim` dimensional unit cube.
+
+    Parameters
+    ----------
+    n : int
+    dim : int
+    random_state : np.random.RandomState, optional
+
+    Returns
+    -------
+    np.ndarray
+        points in rows
+    """
+    random_state = random_state or np.random
+    points = (random_state.rand(n, dim) + np.arange(n)[:, None]) / n
+    for d in range(dim):
+        points[:, d] = points[random_state.permutation(n), d]
+    return points
+
+
+def _map_batches(fun_batch, X, executor, n_parts):
+    """Evaluates `fun_batch` with `executor`, splitting the rows of X to `n_parts`."""
+    parts = executor.map(fun_batch, np.array_split(X, n_parts))
+    return np.concatenate([np.ravel(p) for p in parts])
+
+
+def _differential_evolution(fun_batch, bounds, its, popsize=30, tol=0.01,
+                            mutation=(0.5, 1), recombination=0.7, random_state=None):
+    """Differential evolution (best1bin) that evaluates each generation with one call.
+
+    Uses the same settings as the scipy implementation in `stochastic_optimization`,
+    but the population is updated once per generation.
+
+    Returns
+    -------
+    tuple
+        location and value of the best candidate
+    """
+    random_state = random_state or np.random
+    bounds = np.asarray(bounds, dtype=float)
+    low, scale = bounds[:, 0], bounds[:, 1] - bounds[:, 0]
+    dim = len(bounds)
+    n = max(popsize*dim, 5)
+
+    population = latin_hypercube(n, dim, random_state)
+    energies = np.ravel(fun_batch(low + population*scale))
+
+    for _ in range(its):
+        if np.std(energies) <= tol*np.abs(np.mean(energies)):
+            break
+        best = population[np.argmin(energies)]
+        f = random_state.uniform(*mutation)
+        # Two distinct other members for each member
+        r = np.argsort(random_state.rand(n, n - 1), axis=1)[:, :2]
+        r += r >= np.arange(n)[:, None]
+        mutant = np.clip(best + f*(population[r[:, 0]] - population[r[:, 1]]), 0, 1)
+
+        crossover = random_state.rand(n, dim) < recombination
+        crossover[np.arange(n), random_state.randint(dim, size=n)] = True
+        trial = np.where(crossover, mutant, population)
+
+        trial_energies = np.ravel(fun_batch(low + trial*scale))
+        improved = trial_energies < energies
+        population[improved] = trial[improved]
+        energies[improved] = trial_energies[improved]
+
+    i_best = np.argmin(energies)
+    return low + population[i_best]*scale, energies[i_best]
+
+
+"""
+Random sub streams
+"""
+
+
+def get_seed_state(seed):
+    """Returns the MT19937 state of a RandomState seeded with `seed`.
+
+    Parameters
+    ----------
+    seed : int or sequence of ints
+        See `numpy.random.RandomState`
+
+    Returns
+    -------
+    out : tuple
+    """
+    return np.random.RandomState(seed).get_state()
+
+
+class SubstreamProvider(object):
+    """Provides the seeds for the PRNG sub streams of an inference task.
+
+    The seed of any sub stream is available in constant time (amortized in the legacy
+    mode), so the cost of a new batch does not grow with the number of batches
+    generated before it.
+
+    Parameters
+    ----------
+    master_seed : uint32
+    mode : str, optional
+        "keyed" : the sub stream is seeded with the key (master_seed, substream_index)
+                  using the array seeding of MT19937.
+        "legacy" : reproduces the sub streams of `elfi.core.get_substream_state`. The
+                   seeds are drawn from the master stream only once and cached.
+    """
+
+    MODES = ("keyed", "legacy")
+
+    def __init__(self, master_seed, mode="keyed"):
+        if mode not in self.MODES:
+            raise ValueError("Unknown sub stream mode '{}'. ".format(mode) +
+                             "Expected one of {}.".format(self.MODES))
+        self.master_seed = master_seed
+        self.mode = mode
+        self._master_stream = None
+        self._legacy_seeds = []
+
+    def get_seed(self, substream_index):
+        """Returns the seed for the sub stream.
+
+        Parameters
+        ----------
+        substream_index : uint
+
+        Returns
+        -------
+        seed : int or tuple of ints
+            Can be passed to `get_seed_state`
+        """
+        if self.mode == "legacy":
+            return self._get_legacy_seed(substream_index)
+        # Split the index to 32 bit words so that any index is a valid seed key
+        return (self.master_seed, substream_index & 0xffffffff, substream_index >> 32)
+
+    def get_state(self, substream_index):
+        """Returns the PRNG internal state for the sub stream.
+
+        See Also
+        --------
+        'numpy.random.RandomState.get_state' for the representation of MT19937 state
+        """
+        return get_seed_state(self.get_seed(substream_index))
+
+    def _get_legacy_seed(self, substream_index):
+        n_seeds = len(self._legacy_seeds)
+        if substream_index >= n_seeds:
+            if self._master_stream is None:
+                self._master_stream = np.random.RandomState(self.master_seed)
+            # Grow geometrically to keep the amortized cost constant
+            n_new = max(substream_index + 1 - n_seeds, n_seeds)
+            seeds = self._master_stream.randint(np.iinfo(np.uint32).max, size=n_new)
+            self._legacy_seeds.extend(seeds.tolist())
+        return self._legacy_seeds[substream_index]
@@ -10,7 +10,8 @@ packages = ['elfi'] + ['elfi.' + p for p in find_packages('elfi')]
 
 requirements = [
                 'distributed==1.14.3',
-                'dask>=0.11.1',
+                # keyed_delayed builds graphs from the pre-sharedict Delayed
+                'dask>=0.11.1,<0.14',
                 'numpy>=1.8',
                 'scipy>=0.16.1',
                 'matplotlib>=1.1',
@@ -2,6 +2,7 @@ import numpy as np
 import random
 
 from elfi.bo.utils import approx_second_partial_derivative
+from elfi.bo.utils import approx_second_partial_derivatives
 from elfi.bo.utils import sum_of_rbf_kernels
 
 class Test_sum_of_rbf_kernels():
@@ -33,6 +34,14 @@ class Test_sum_of_rbf_kernels():
         ret = sum_of_rbf_kernels(point, kern_centers, kern_ampl, kern_scale)
         assert abs(ret - 2*np.exp(-1.0)) < 1e-5
 
+    def test_batch(self):
+        """ Test that points on rows are evaluated at once """
+        points = np.random.uniform(0, 1, (5, 2))
+        kern_centers = np.random.uniform(0, 1, (3, 2))
+        ret = sum_of_rbf_kernels(points, kern_centers, 0.5, 0.3)
+        expected = [sum_of_rbf_kernels(p, kern_centers, 0.5, 0.3) for p in points]
+        np.testing.assert_allclose(ret, expected)
+
 
 class Test_approx_second_partial_derivative():
 
@@ -69,4 +78,14 @@ class Test_approx_second_partial_derivative():
         ret = approx_second_partial_derivative(fun, x0, dim, h, bounds)
         assert abs(ret - 2) < 1e-5
 
-
+    def test_all_dims_at_once(self):
+        """ Test that the batch approximation matches the one dimension at a time one """
+        fun = lambda x: x[0]**2 + 3*x[0]*x[1]**2
+        fun_batch = lambda X: np.array([fun(x) for x in X])
+        x0 = np.atleast_1d([random.uniform(-1,1), 0.0])
+        h = 0.001
+        bounds = ((-1.1, 1.1),(0, 1))
+        ret = approx_second_partial_derivatives(fun_batch, x0, h, bounds)
+        for dim in range(2):
+            expected = approx_second_partial_derivative(fun, x0, dim, h, bounds)
+            assert abs(ret[dim] - expected) < 1e-5
@@ -52,6 +52,81 @@ class Test_GPyModel():
         assert abs(pred1[0] + pred2[0]) < 1e-3
         np.testing.assert_allclose(pred1[1:2], pred2[1:2], atol=1e-3)
 
+    def test_incremental_update(self):
+        bounds = ((0, 1), (0, 1))
+        X = np.random.uniform(0, 1, (6, 2))
+        Y = np.random.randn(6, 1)
+        gp = GPyModel(input_dim=2, bounds=bounds, max_opt_iters=0)
+        gp.update(X[0:2], Y[0:2])
+        gp.update(X[2:3], Y[2:3])
+        gp.update(X[3:6], Y[3:6])
+        assert gp.n_observations == 6
+
+        x = np.random.uniform(0, 1, (1, 2))
+        pred = gp.evaluate(x[0])
+        # Compare to a full fit with the same hyperparameters
+        gp.gp.set_XY(X, Y)
+        m, s2 = gp.gp.predict(x)
+        np.testing.assert_allclose(pred, (m[0, 0], s2[0, 0], np.sqrt(s2[0, 0])))
+        L = gp._L.copy()
+        gp._factorize()
+        np.testing.assert_allclose(L, gp._L)
+
+    def test_optimized_update(self):
+        bounds = ((0, 1), (0, 1))
+        X = np.random.uniform(0, 1, (6, 2))
+        Y = np.random.randn(6, 1)
+        gp = GPyModel(input_dim=2, bounds=bounds)
+        gp.update(X[0:3], Y[0:3])
+        gp.update(X[3:6], Y[3:6])
+        assert gp.n_observations == 6
+
+        x = np.random.uniform(0, 1, (5, 2))
+        m, s2 = gp.evaluate_batch(x)
+        m_gpy, s2_gpy = gp.gp.predict(x)
+        np.testing.assert_allclose(m, m_gpy[:, 0], atol=1e-6)
+        np.testing.assert_allclose(s2, s2_gpy[:, 0], atol=1e-6)
+        L = gp._L.copy()
+        gp._factorize()
+        np.testing.assert_allclose(L, gp._L, atol=1e-6)
+
+    def test_evaluate_batch(self):
+        bounds = ((0, 1), (0, 1))
+        X = np.random.uniform(0, 1, (4, 2))
+        Y = np.random.randn(4, 1)
+        gp = GPyModel(input_dim=2, bounds=bounds)
+        x = np.random.uniform(0, 1, (5, 2))
+        m, s2 = gp.evaluate_batch(x)
+        assert m.shape == s2.shape == (5,)
+        gp.update(X, Y)
+        m, s2 = gp.evaluate_batch(x)
+        for i in range(5):
+            np.testing.assert_allclose(gp.evaluate(x[i]), (m[i], s2[i], np.sqrt(s2[i])))
+        m_gpy, s2_gpy = gp.gp.predict(x)
+        np.testing.assert_allclose(m, m_gpy[:, 0])
+        np.testing.assert_allclose(s2, s2_gpy[:, 0])
+
+    def test_evaluate_gradients(self):
+        bounds = ((0, 1), (0, 1))
+        X = np.random.uniform(0, 1, (5, 2))
+        Y = np.random.randn(5, 1)
+        gp = GPyModel(input_dim=2, bounds=bounds, max_opt_iters=0)
+        gp.update(X, Y)
+        x = np.random.uniform(0.1, 0.9, (3, 2))
+        d_mean, d_var = gp.evaluate_gradients(x)
+        assert d_mean.shape == d_var.shape == (3, 2)
+
+        h = 1e-6
+        for dim in range(2):
+            step = np.zeros(2)
+            step[dim] = h
+            m_p, v_p = gp.evaluate_batch(x + step)
+            m_m, v_m = gp.evaluate_batch(x - step)
+            np.testing.assert_allclose(d_mean[:, dim], (m_p - m_m) / (2*h),
+                                       rtol=1e-4, atol=1e-6)
+            np.testing.assert_allclose(d_var[:, dim], (v_p - v_m) / (2*h),
+                                       rtol=1e-4, atol=1e-6)
+
     # FIXME
     # def test_change_kernel(self):
     #     bounds = ((0, 1), )
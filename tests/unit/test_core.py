@@ -1,12 +1,17 @@
 from functools import partial
 import pytest
 
+import cloudpickle
 import numpy as np
 
 import elfi
 from elfi.core import normalize_data, simulator_transform
+from elfi.core import DelayedOutputCache
+from elfi.utils import make_key, get_key_slice
+from dask.delayed import delayed
 from elfi.core import Node
 from elfi.core import ObservedMixin
+from elfi.storage import SimulationCache
 
 from mocks import MockSimulator, MockSequentialSimulator
 from mocks import MockSummary, MockSequentialSummary
@@ -92,6 +97,225 @@ def test_generate_vs_acquire():
     assert np.array_equal(np.vstack((ar1, ar2)), ar12)
 
 
+def test_normalize_data_broadcast():
+    data = normalize_data(np.arange(1000), n=100)
+    assert data.shape == (100, 1000)
+    assert not data.flags.writeable
+    assert data.strides[0] == 0
+    data = normalize_data(np.arange(1000), n=100, writable=True)
+    assert data.flags.writeable
+
+
+def test_writable_inputs():
+    def mutating_summary(x):
+        x += 1
+        return x
+
+    mu = elfi.Prior('mu', 'uniform', 0, 4)
+    s = elfi.Summary('s', mutating_summary, mu, observed=0)
+    elfi.client()
+    try:
+        with pytest.raises(ValueError):
+            s.generate(3, with_values={'mu': 1}).compute()
+        s.redefine(mutating_summary, writable_inputs=True)
+        assert np.array_equal(s.generate(3, with_values={'mu': 1}).compute(),
+                              [[2]] * 3)
+    finally:
+        elfi.env.client().shutdown()
+
+
+def test_replicated_values_are_sent_as_one_row():
+    elfi.new_inference_task()
+    mu = elfi.Prior('mu', 'uniform', 0, 4)
+    s = elfi.Summary('s', lambda x: x.sum(axis=1, keepdims=True), mu, observed=0)
+    output = s.generate(1000, with_values={'mu': np.ones(100)})
+    # The graph holds only the single row of 100 values
+    assert len(cloudpickle.dumps(dict(output.dask))) < 100 * 1000
+    elfi.client()
+    try:
+        assert np.array_equal(output.compute(), [[100.]] * 1000)
+    finally:
+        elfi.env.client().shutdown()
+
+
+def test_evaluate_at(tmpdir):
+    # The workers record the calls to a file
+    calls = str(tmpdir.join('calls'))
+    def simulator(mu, batch_size, random_state):
+        with open(calls, 'a') as f:
+            f.write("{}\n".format(batch_size))
+        return 2 * mu
+
+    mu = elfi.Prior('mu', 'uniform', 0, 4)
+    sim = elfi.Simulator('sim', simulator, mu, observed=0)
+    mu.inference_task.parameters = [mu]
+    values = np.array([[1.], [2.], [3.]])
+    elfi.client()
+    try:
+        outputs = sim.evaluate_at(values)
+        assert len(outputs) == 3
+        for i, output in enumerate(outputs):
+            assert np.array_equal(output.result(), 2 * values[i:i+1])
+        # The simulator is called once for all the points
+        with open(calls) as f:
+            assert f.read().split() == ['3']
+        # The points are appended after the already generated values
+        outputs = sim.evaluate_at({'mu': [4., 5.]})
+        assert outputs[1].result() == 10
+        assert sim._generate_index == 5
+    finally:
+        elfi.env.client().shutdown()
+
+
+class TestDelayedOutputCache():
+
+    def get_cache(self, batch_sizes):
+        cache = DelayedOutputCache('node')
+        start = 0
+        for n in batch_sizes:
+            sl = slice(start, start + n)
+            output = {'data': np.arange(sl.start, sl.stop)[:, None]}
+            cache.append(delayed(output, name=make_key('node', sl)))
+            start += n
+        return cache
+
+    def test_len_and_get(self):
+        cache = self.get_cache([3, 1, 5])
+        assert len(cache) == 9
+        assert cache.get(3).key == make_key('node', slice(3, 4))
+        assert cache.get(4).compute()['data'].shape == (5, 1)
+        with pytest.raises(IndexError):
+            cache.get(2)
+
+    def test_slices(self):
+        cache = self.get_cache([3, 1, 5, 2])
+        for sl in [slice(0, 11), slice(1, 2), slice(2, 5), slice(3, 4), slice(4, 11)]:
+            data = cache[sl].compute()
+            assert np.array_equal(data, np.arange(sl.start, sl.stop)[:, None])
+
+    def test_slice_assembly_tasks(self):
+        cache = self.get_cache([3, 1, 5])
+        # A slice within one output is a single getitem on that output
+        dsk = cache[slice(4, 6)].dask
+        assert len([k for k in dsk if get_key_slice(k) == slice(4, 6)]) == 1
+        # Several outputs are assembled in a single task
+        output = cache[slice(2, 7)]
+        assert output.key == make_key('node/data', slice(2, 7))
+        assert len([k for k in output.dask if get_key_slice(k) == slice(2, 7)]) == 1
+
+    def test_append_non_matching_slice(self):
+        cache = self.get_cache([3])
+        with pytest.raises(ValueError):
+            cache.append(delayed({}, name=make_key('node', slice(4, 5))))
+
+    def test_set_stored(self):
+        cache = self.get_cache([3, 1])
+        cache._set_stored(make_key('node', slice(3, 4)), None)
+        assert cache._stored_mask == [False, True]
+        with pytest.raises(LookupError):
+            cache._set_stored(make_key('node', slice(1, 4)), None)
+
+
+def noisy_simulator(p, batch_size, random_state):
+    return p + random_state.rand(batch_size, 1)
+
+
+def get_noisy_model(fuse=False, simulator=noisy_simulator):
+    """Returns the discrepancy, the simulator and the uniform prior `p` of a model
+    simulating `p` with noise. The model is created in a new inference task.
+    """
+    itask = elfi.new_inference_task(seed=123)
+    p = elfi.Prior('p', 'uniform')
+    sim = elfi.Simulator('sim', simulator, p, observed=np.zeros(1))
+    d = elfi.Discrepancy('d', lambda x, y: np.abs(x[0] - y[0]), sim, fuse=fuse)
+    itask.parameters = [p]
+    return d, sim, p
+
+
+class TestDiscrepancyFusion():
+
+    def test_fused_outputs_equal(self):
+        d, sim, p = get_noisy_model()
+        d_fused, sim_fused, p_fused = get_noisy_model(fuse=True)
+        dist, params = d.acquire(10, batch_size=4).compute(), p.acquire(10).compute()
+        dist_fused = d_fused.acquire(10, batch_size=4)
+        params_fused = p_fused.acquire(10)
+        assert np.array_equal(dist, dist_fused.compute())
+        assert np.array_equal(params, params_fused.compute())
+
+    def test_fused_batch_is_one_task(self):
+        d, sim, p = get_noisy_model(fuse=True)
+        d.acquire(4)
+        fused_key = make_key(d.id + '/fused', slice(0, 4))
+        assert d.get_delayed_output(0).dask.keys() == {fused_key,
+                                                       make_key(d.id, slice(0, 4))}
+        assert fused_key in p.get_delayed_output(0).dask
+
+    def test_fused_outputs_are_complete(self):
+        d, sim, p = get_noisy_model()
+        d.acquire(4)
+        keys = set(p.get_delayed_output(0).compute().keys())
+        d, sim, p = get_noisy_model(fuse=True)
+        d.acquire(4)
+        assert set(p.get_delayed_output(0).compute().keys()) == \
+            keys - {'observed', 'random_state'}
+
+
+class TestBroadcast():
+
+    def test_broadcast_outputs_equal(self):
+        d, sim, p = get_noisy_model()
+        expected = d.acquire(10, batch_size=4).compute()
+        elfi.client()
+        elfi.env.set_option(broadcast=True)
+        try:
+            for fuse in (False, True):
+                d, sim, p = get_noisy_model(fuse)
+                assert np.array_equal(d.acquire(10, batch_size=4).compute(), expected)
+                # The transform and the observed data are referred by a handle
+                assert set(d._static_payloads.keys()) == {'transform', 'observed'}
+                d.reset()
+                assert len(d._static_payloads) == 0
+        finally:
+            elfi.env.clear_option('broadcast')
+            elfi.env.client().shutdown()
+
+
+# The calls are recorded in a global so that they are not a part of the simulator token
+_simulator_calls = []
+
+
+def cached_simulator(p, batch_size, random_state):
+    _simulator_calls.append(batch_size)
+    return p + random_state.rand(batch_size, 1)
+
+
+class TestSimulationCache():
+
+    def test_outputs_are_reused(self, tmpdir):
+        del _simulator_calls[:]
+        d, sim, p = get_noisy_model(simulator=cached_simulator)
+        expected = d.acquire(10, batch_size=5).compute()
+        assert len(_simulator_calls) == 2
+
+        elfi.env.set_option(cache=SimulationCache(str(tmpdir)))
+        try:
+            for i in range(2):
+                d, sim, p = get_noisy_model(simulator=cached_simulator)
+                assert np.array_equal(d.acquire(10, batch_size=5).compute(), expected)
+            assert len(_simulator_calls) == 4
+            # A different batch is computed
+            d.acquire(15, batch_size=5).compute()
+            assert len(_simulator_calls) == 5
+            # Redefining the simulator changes the tokens of its outputs
+            token = sim.structure_token
+            sim.redefine(lambda p, batch_size, random_state: p + 1)
+            assert sim.structure_token != token
+            assert np.allclose(d.acquire(10).compute(), p.acquire(10).compute() + 1)
+        finally:
+            elfi.env.clear_option('cache')
+
+
 def test_same_key_error():
     elfi.Transform('op', lambda _:_)
     with pytest.raises(SystemExit) as e:
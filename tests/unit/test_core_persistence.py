@@ -76,3 +76,27 @@ class TestPersistence():
         assert res[0][0] == 1
 
         elfi.env.client().shutdown()
+
+
+def test_memory_store_budget(tmpdir):
+    for spill_dir in (None, str(tmpdir)):
+        elfi.new_inference_task()
+        store = elfi.MemoryStore(max_bytes=2000, spill_dir=spill_dir)
+        simulator = lambda batch_size, random_state: random_state.rand(batch_size, 100)
+        sim = elfi.Simulator("sim", simulator, observed=0, store=store)
+        # Each output has 800 bytes of data
+        expected = sim.acquire(4, batch_size=1).compute()
+        t0 = timeit.default_timer()
+        while store.evictions < 2 and timeit.default_timer() - t0 < 5:
+            time.sleep(.01)
+        assert store.evictions == 2
+        assert store.nbytes == 1600
+
+        assert np.array_equal(sim.acquire(4).compute(), expected)
+        if spill_dir is None:
+            assert (store.hits, store.misses) == (2, 2)
+        else:
+            assert (store.hits, store.misses) == (4, 0)
+            assert len(tmpdir.listdir()) == 2
+
+    elfi.env.client().shutdown()
@@ -1,5 +1,8 @@
+import time
+
 import pytest
 import numpy as np
+import scipy.stats as ss
 
 import elfi
 from elfi import weighted_cov
@@ -45,6 +48,73 @@ class TestSMCDistribution():
         assert I > .99
         assert I < 1.01
 
+    def test_pdf_and_logpdf(self):
+        rs = np.random.RandomState(123)
+        pop = rs.randn(50, 2)
+        weights = rs.rand(50)
+        smc = elfi.SMCProposal(pop, weights)
+        x = rs.randn(20, 2)
+
+        kernel = ss.multivariate_normal(mean=[0, 0],
+                                        cov=2*weighted_cov(smc.samples, weights))
+        expected = [np.sum(smc.weights * kernel.pdf(xi - smc.samples)) for xi in x]
+        assert np.allclose(smc.pdf(x), expected)
+        assert np.allclose(smc.logpdf(x), np.log(expected))
+
+        # Blocked evaluation
+        smc.block_size = 100
+        assert np.allclose(smc.pdf(x), expected)
+
+        # Truncated kernels
+        smc_truncated = elfi.SMCProposal(pop, weights, truncation=6)
+        assert np.allclose(smc_truncated.pdf(x), expected, rtol=1e-6)
+        assert smc_truncated.logpdf([[100, 100]])[0] == -np.inf
+
+    def test_local_kernels(self):
+        rs = np.random.RandomState(123)
+        pop = rs.randn(30, 2)
+        weights = rs.rand(30)
+        x = rs.randn(10, 2)
+        w = weights / np.sum(weights)
+
+        reference = np.arange(10)
+        smc = elfi.SMCProposal(pop, weights, kernel='olcm')
+        smc.set_population(pop, weights, reference=reference)
+        w_ref = w[reference] / np.sum(w[reference])
+        expected = 0
+        for i in range(30):
+            diff = pop[reference] - pop[i]
+            cov = np.dot(diff.T, w_ref[:, None]*diff)
+            expected = expected + w[i]*ss.multivariate_normal.pdf(x, pop[i], cov)
+        assert np.allclose(smc.pdf(x), expected)
+
+        # A single reference sample gives singular covariances
+        smc.set_population(pop, weights, reference=[0])
+        global_smc = elfi.SMCProposal(pop, weights)
+        assert np.allclose(smc.pdf(x), global_smc.pdf(x))
+        assert np.all(np.isfinite(smc.rvs(4, random_state=rs)))
+
+        smc = elfi.SMCProposal(pop, weights, kernel='knn', n_neighbors=5)
+        expected = 0
+        for i in range(30):
+            inds = np.argsort(np.sum((pop - pop[i])**2, axis=1))[:5]
+            cov = 2*weighted_cov(pop[inds], weights[inds])
+            expected = expected + w[i]*ss.multivariate_normal.pdf(x, pop[i], cov)
+        assert np.allclose(smc.pdf(x), expected)
+        assert smc.rvs(4, random_state=rs).shape == (4, 2)
+
+        # Two neighbours in two dimensions give singular covariances
+        smc = elfi.SMCProposal(pop, weights, kernel='knn', n_neighbors=2)
+        assert np.allclose(smc.pdf(x), global_smc.pdf(x))
+        assert np.all(np.isfinite(smc.rvs(4, random_state=rs)))
+
+        smc = elfi.SMCProposal([[1], [5], [10]], [10, 100, 1000], kernel='knn')
+        I = np.sum(smc.pdf(np.arange(-100, 100, .25)[:, None]))*.25
+        assert np.abs(I - 1) < .01
+
+        with pytest.raises(ValueError):
+            elfi.SMCProposal(pop, kernel='knn', truncation=6)
+
     def test_rvs_shape(self):
         smc = self.get_smc()
         assert smc.rvs(3).shape == (3,1)
@@ -52,6 +122,52 @@ class TestSMCDistribution():
         smc = elfi.SMCProposal([[1,1], [2,2]])
         assert smc.rvs(1).shape == (1,2)
 
+    def test_rvs_uses_cached_factor(self):
+        pop = np.array([[0., 0.], [1., 2.], [3., 1.]])
+        weights = [1, 2, 3]
+        smc = elfi.SMCProposal(pop, weights)
+        s = smc.rvs(5, random_state=np.random.RandomState(0))
+
+        rs = np.random.RandomState(0)
+        inds = rs.choice(3, size=5, p=smc.weights)
+        chol = np.linalg.cholesky(2*weighted_cov(pop, weights))
+        expected = pop[inds] + np.dot(rs.standard_normal(size=(5, 2)), chol.T)
+        assert np.allclose(s, expected)
+
+
+def test_smc_batch_weights():
+    q = elfi.SMCProposal([[0., 0.], [1., 1.]])
+    distances = np.array([[.1], [.5], [.2]])
+    parameter_outputs = [{'data': np.array([[1.], [2.], [3.]]),
+                          'pdf': np.array([1., 2., 3.])},
+                         {'data': np.array([[4.], [5.], [6.]]),
+                          'pdf': np.array([2., 2., 2.])}]
+    batch = elfi.methods.smc_batch_weights(distances, parameter_outputs, .3, q)
+    assert np.array_equal(batch['distances'], [[.1], [.2]])
+    assert np.array_equal(batch['samples'], [[1., 4.], [3., 6.]])
+    samples = np.array([[1., 4.], [3., 6.]])
+    assert np.array_equal(batch['prior_pdf'], [2., 6.])
+    assert np.allclose(batch['weights'], np.array([2., 6.]) / q.pdf(samples))
+    assert batch['n_sim'] == 3
+
+
+def test_smc_mis_weights():
+    q1 = elfi.SMCProposal([[0.], [1.]])
+    q2 = elfi.SMCProposal([[2.], [4.]])
+    sources = [{'samples': np.array([[.5], [1.5]]), 'distances': np.array([[.1], [.2]]),
+                'prior_pdf': np.array([1., 2.]), 'proposal': q1, 'n_sim': 10},
+               {'samples': np.array([[3.], [2.5], [4.]]),
+                'distances': np.array([[.3], [.1], [.2]]),
+                'prior_pdf': np.array([3., 4., 5.]), 'proposal': q2, 'n_sim': 30}]
+    samples, distances, weights, prior_pdf = elfi.methods.smc_mis_weights(sources, 4)
+
+    assert np.array_equal(samples, [[.5], [1.5], [3.], [2.5]])
+    assert np.array_equal(distances, [[.1], [.2], [.3], [.1]])
+    assert np.array_equal(prior_pdf, [1., 2., 3., 4.])
+    # Two of the three particles of the second source correspond to 20 simulations
+    mixture = 10*q1.pdf(samples) + 20*q2.pdf(samples)
+    assert np.allclose(weights, prior_pdf / mixture)
+
 
 # TODO: Rewrite as a InferenceTask, do not derive subclasses from this
 class MockModel():
@@ -122,6 +238,20 @@ class TestABCMethod(MockModel):
         assert isinstance(parameters, list)
         assert parameters[0].shape == (n_sim, 1)
 
+    def test_acquire_single_pass(self):
+        calls = []
+        def parameter(batch_size, random_state):
+            calls.append(batch_size)
+            return random_state.rand(batch_size, 1)
+
+        p = elfi.Simulator('p', parameter, observed=0)
+        d = elfi.Discrepancy('d', lambda x, y: x[0], p)
+        abc = elfi.ABCMethod(d, [p], batch_size=2)
+        distances, parameters = abc._acquire(4)
+        # The parameter is computed once for both outputs
+        assert calls == [2, 2]
+        assert np.array_equal(distances, parameters[0])
+
 
 # Tests for rejection sampling
 class TestRejection(MockModel):
@@ -146,6 +276,26 @@ class TestRejection(MockModel):
         assert self.mock_sum_calls == int(n / quantile) + 1
         assert self.mock_dis_calls == int(n / quantile)
 
+    def test_quantile_streaming(self):
+        self.set_simple_model()
+
+        n = 20
+        quantile = 0.1
+        rej = elfi.Rejection(self.d, [self.p], batch_size=30)
+        result = rej.sample(n, quantile=quantile)
+        # The streaming mode uses the same simulations with a different batch size
+        rej = elfi.Rejection(self.d, [self.p], batch_size=7)
+        try:
+            result_streaming = rej.sample(n, quantile=quantile, streaming=True)
+        finally:
+            elfi.env.client().shutdown()
+
+        assert np.array_equal(result.samples_list[0], result_streaming.samples_list[0])
+        assert np.array_equal(result.distances, result_streaming.distances)
+        assert result.threshold == result_streaming.threshold
+        assert result.n_sim == result_streaming.n_sim
+        assert result.accept_rate == result_streaming.accept_rate
+
     def test_threshold(self):
         self.set_simple_model()
 
@@ -165,6 +315,19 @@ class TestRejection(MockModel):
         assert self.mock_dis_calls >= int(n)
         assert np.all(list(result.samples.values())[0] < threshold)  # makes sense only for MockModel!
 
+    def test_threshold_is_incremental(self):
+        self.set_simple_model()
+
+        rej = elfi.Rejection(self.d, [self.p], batch_size=5)
+        # Needs more than one round of proposals
+        result = rej.sample(20, threshold=0.2)
+        assert result.n_sim > rej._ceil_in_batch_sizes(20)
+        # Each simulation is run once
+        assert self.mock_sim_calls == result.n_sim
+        assert self.mock_dis_calls == result.n_sim
+        assert result.accept_rate == np.sum(rej.distance_node.acquire(result.n_sim)
+                                            .compute() <= 0.2) / result.n_sim
+
     def test_reject(self):
         self.set_simple_model()
 
@@ -183,6 +346,107 @@ class TestRejection(MockModel):
         assert np.all(list(result.samples.values())[0] < threshold)  # makes sense only for MockModel!
 
 
+class TestSMC(MockModel):
+
+    def teardown_method(self, method):
+        # The batches are computed with the distributed client
+        client = elfi.env.get_option('client')
+        if client is not None:
+            client.shutdown()
+
+    def test_cancel_surplus_batches(self):
+        self.set_simple_model()
+
+        def slow_simulator(p, batch_size, random_state):
+            time.sleep(.05)
+            return np.hstack([p, p])
+        self.Y.redefine(slow_simulator)
+
+        n = 10
+        batch_size = 5
+        smc = elfi.SMC(self.d, [self.p], batch_size=batch_size)
+        # Submit far more batches than there are cores to compute them
+        smc.estimate_batches_needed = lambda n_samples, accept_rate: 8*smc.ncores
+        cancelled = []
+        cancel_batches = smc._cancel_batches
+        def record_cancelled():
+            cancelled.extend(smc.batch_futures)
+            return cancel_batches()
+        smc._cancel_batches = record_cancelled
+        result = smc.sample(n, 3, [.5, .2, .1])
+
+        assert result.n_samples == n
+        assert len(result.weights) == n
+        assert np.all(result.distances <= .1)
+        assert len(result.n_sim_saved_history) == 2
+        assert sum(result.n_sim_saved_history) == len(cancelled)*batch_size > 0
+        assert all(f.cancelled() for f in cancelled)
+        assert smc.batch_futures == []
+
+    def test_fused_discrepancy(self):
+        self.set_simple_model()
+        d = elfi.Discrepancy('d_fused', self.mock_discrepancy, self.S, fuse=[self.p])
+
+        n = 10
+        smc = elfi.SMC(d, [self.p], batch_size=5)
+        result = smc.sample(n, 2, [.5, .2])
+        assert result.n_samples == n
+        assert np.all(result.distances <= .2)
+
+    def test_adaptive_schedule(self):
+        self.set_simple_model()
+
+        n = 10
+        smc = elfi.SMC(self.d, [self.p], batch_size=5)
+        result = smc.sample(n, 4, quantile=.5)
+
+        assert result.n_populations == 4
+        thresholds = result.threshold_history + [result.threshold]
+        assert np.all(np.diff(thresholds) <= 0)
+        assert np.all(result.distances <= result.threshold)
+        # Each threshold is the median distance of the previous population
+        distances = result.distances_history
+        for i in range(1, 4):
+            assert thresholds[i] == np.percentile(distances[i-1], 50)
+
+    def test_recycle(self):
+        self.set_simple_model()
+
+        n = 10
+        smc = elfi.SMC(self.d, [self.p], batch_size=5)
+        # The second and the third thresholds are the same
+        result = smc.sample(n, 3, [.5, .2, .2], recycle=True)
+
+        # All the particles of the second population are reused
+        assert result.n_sim == 0
+        assert np.array_equal(result.samples_list[0], result.samples_history[1][0])
+        assert np.all(result.distances <= .2)
+
+        elfi.new_inference_task()
+        self.set_simple_model()
+        smc = elfi.SMC(self.d, [self.p], batch_size=5)
+        result = smc.sample(n, 2, [.5, .5], recycle=True)
+        # The rejection sampled particles are reused with the prior as the proposal
+        assert result.n_sim == 0
+        assert np.array_equal(result.samples_list[0], result.samples_history[0][0])
+        assert np.allclose(result.weights, result.weights[0])
+
+    def test_stopping_rules(self):
+        self.set_simple_model()
+
+        smc = elfi.SMC(self.d, [self.p], batch_size=5)
+        result = smc.sample(10, 10, quantile=.5, max_sim=20)
+        # The initial rejection sampling uses the whole budget
+        assert result.n_populations == 1
+        assert result.n_sim_total == 20
+
+        elfi.new_inference_task()
+        self.set_simple_model()
+        smc = elfi.SMC(self.d, [self.p], batch_size=5)
+        result = smc.sample(10, 10, [.5, .4, .3], min_accept_rate=1.1)
+        assert result.n_populations == 1
+
+
 class TestBOLFI(MockModel):
 
     def set_basic_bolfi(self):
@@ -235,3 +499,19 @@ class TestBOLFI(MockModel):
         assert len(models) == self.n_sim + 1
         for i in range(self.n_sim+1):
             assert type(models[i]) == type(bolfi.model), i
+
+    def test_sample(self):
+        self.set_simple_model()
+        self.set_basic_bolfi()
+        bolfi = elfi.BOLFI(self.d, [self.p], self.n_batch,
+                           n_surrogate_samples=self.n_sim)
+        result = bolfi.sample(50, n_chains=10, burn_in=20, seed=1)
+        assert bolfi.model.n_observations == self.n_sim
+        assert result.method == 'BOLFI'
+        assert result.samples_list[0].shape == (50, 1)
+        assert np.all((result.samples_list[0] >= 0) & (result.samples_list[0] <= 1))
+        assert 0 < result.accept_rate <= 1
+
+        samples, accept_rate = result.posterior.sample_mcmc(50, n_chains=10,
+                                                            burn_in=20, seed=1)
+        assert np.array_equal(result.samples_list[0], samples)
@@ -1,5 +1,6 @@
 import numpy as np
 from elfi.core import get_substream_state
+from elfi.utils import SubstreamProvider
 
 
 def test_sub_streams():
@@ -13,4 +14,23 @@ def test_sub_streams():
         state = get_substream_state(master_seed, sub_index)
         stream.set_state(state)
         rands.append(stream.randint(int(1e6)))
-    assert rands[0] == rands[1]
\ No newline at end of file
+    assert rands[0] == rands[1]
+
+def test_legacy_substreams():
+    """The legacy mode must reproduce the streams of `get_substream_state`
+    """
+    master_seed = 123
+    provider = SubstreamProvider(master_seed, mode="legacy")
+    for sub_index in [3, 0, 10, 4, 25]:
+        state = provider.get_state(sub_index)
+        legacy_state = get_substream_state(master_seed, sub_index)
+        assert np.array_equal(state[1], legacy_state[1])
+
+
+def test_keyed_substreams():
+    provider = SubstreamProvider(123)
+    states = [provider.get_state(i)[1] for i in range(3)]
+    assert np.array_equal(states[1], SubstreamProvider(123).get_state(1)[1])
+    assert not np.array_equal(states[0], states[1])
+    assert not np.array_equal(states[1], states[2])
+    assert not np.array_equal(states[1], SubstreamProvider(124).get_state(1)[1])
@@ -1,9 +1,12 @@
 import os
 
+import numpy as np
+
 from test_core_persistence import TestPersistence
 
 from elfi.storage import UnQLiteDatabase
 from elfi.storage import DictListStore
+from elfi.storage import SimulationCache
 
 
 def database_read_write_test(db):
@@ -66,3 +69,29 @@ class TestStoragePersistence(TestPersistence):
     def test_dictlist_cache(self):
         local_store = DictListStore()
         self.run_local_object_cache_test(local_store)
+
+
+def test_simulation_cache_eviction(tmpdir):
+    cache = SimulationCache(str(tmpdir), max_size=None)
+    for i in range(3):
+        cache.save(str(i), {"data": np.zeros(100), "observed": np.zeros(1000)})
+        # Make the access times distinguishable
+        os.utime(cache._filename(str(i)), (i, i))
+    size = cache.size
+    assert size < 3 * 1000 * 8
+    cache.load("0")
+    cache.max_size = size
+    cache.save("3", {"data": np.zeros(100)})
+    # The least recently used outputs are removed until the size is below the limit
+    # by a margin
+    assert "0" in cache and "1" not in cache and "2" not in cache and "3" in cache
+    assert cache._size == cache.size <= size*(1 - cache.evict_fraction)
+    # Below the limit the directory is not listed
+    def fail():
+        raise AssertionError("The cache directory was listed")
+    cache._entries = fail
+    cache.save("4", {"data": np.zeros(10)})
+    del cache._entries
+    assert cache._size == cache.size
+    cache.clear()
+    assert cache.size == 0
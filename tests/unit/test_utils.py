@@ -1,7 +1,16 @@
+import os
+import subprocess
+import sys
+
 import numpy as np
+import scipy.stats as ss
 
 import elfi
-from elfi.utils import stochastic_optimization, weighted_cov
+from functools import partial
+
+from elfi.utils import stochastic_optimization, weighted_cov, keyed_delayed, make_token
+from elfi.utils import multistart_optimization
+from dask.delayed import delayed
 
 
 class TestStochasticOptimization():
@@ -15,9 +24,110 @@ class TestStochasticOptimization():
         assert abs(loc - 0.0) < 1e-5
         assert abs(val - 0.0) < 1e-5
 
+    def test_vectorized(self):
+        calls = []
+        def fun(X):
+            calls.append(len(X))
+            return np.sum((X - [.5, -.2])**2, axis=1)
+        bounds = ((-1, 1), (-1, 1))
+        rs = np.random.RandomState(0)
+        loc, val = stochastic_optimization(fun, bounds, 1000, vectorized=True,
+                                           random_state=rs)
+        assert np.allclose(loc, [.5, -.2], atol=1e-2)
+        assert val < 1e-3
+        # The whole population is evaluated at once
+        assert all(n == 60 for n in calls)
+
+        loc_workers, val_workers = stochastic_optimization(
+            fun, bounds, 1000, vectorized=True, workers=4,
+            random_state=np.random.RandomState(0))
+        assert np.array_equal(loc, loc_workers)
+        assert val == val_workers
+
+
+def test_multistart_optimization():
+    # Local minima near -1 and 1, the global one near 1
+    fun = lambda x: ((x[0]**2 - 1)**2 - .2*x[0], np.array([4*x[0]*(x[0]**2 - 1) - .2]))
+    bounds = ((-2, 2),)
+    loc, val = multistart_optimization(fun, bounds, n_starts=5,
+                                       random_state=np.random.RandomState(0))
+    assert abs(loc[0] - 1.02) < 1e-2
+    assert np.isclose(val, fun(loc)[0])
+
+    # Starting only from an initial point in the other basin
+    loc, val = multistart_optimization(fun, bounds, n_starts=0, initial=[[-1.5]])
+    assert loc[0] < 0
+
 
 def test_weighted_cov():
     cov = [[.5, -.3], [-.3, .7]]
     x = np.random.RandomState(12345).multivariate_normal([1,2], cov, 1000)
     w = [1]*len(x)
     assert np.linalg.norm(weighted_cov(x, w) - cov) < .1
+
+
+def test_keyed_delayed():
+    a = delayed(np.ones(2), name='a')
+    b = keyed_delayed(('b', 0, 2), lambda x: x * 2, a)
+    add = lambda dct: dct['data'][0] + dct['data'][1] + dct['n']
+    c = keyed_delayed(('c', 0, 2), add, {'data': (a, b), 'n': 1})
+    assert c.key == ('c', 0, 2)
+    assert set(c.dask.keys()) == {'a', ('b', 0, 2), ('c', 0, 2)}
+    assert np.array_equal(c.compute(), [4, 4])
+
+
+def test_make_token():
+    def op(x, c=1):
+        return x + c
+    token = make_token(partial(op, c=2), np.arange(3), 'a')
+    assert token == make_token(partial(op, c=2), np.arange(3), 'a')
+    assert token != make_token(partial(op, c=3), np.arange(3), 'a')
+    assert token != make_token(partial(lambda x, c=1: x - c, c=2), np.arange(3), 'a')
+
+
+_token_scale = 2.
+
+
+def _scaled(x):
+    return _token_scale * x
+
+
+def test_make_token_defaults_and_globals(monkeypatch):
+    def op(x, sigma=1.):
+        return x * sigma
+    token = make_token(op)
+    op.__defaults__ = (5.,)
+    assert make_token(op) != token
+
+    token = make_token(_scaled)
+    monkeypatch.setitem(_scaled.__globals__, '_token_scale', 3.)
+    assert make_token(_scaled) != token
+
+
+_token_script = """
+import numpy as np
+import scipy.stats as ss
+import elfi
+from elfi.utils import make_token
+
+np.random.rand()
+elfi.new_inference_task()
+p = elfi.Prior('p', 'uniform')
+q = elfi.Prior('q', ss.norm)
+print(make_token(p.structure_token, q.structure_token, ss.norm(1, 2)))
+"""
+
+
+def test_make_token_is_stable_across_sessions():
+    # Tokens of scipy distributions do not depend on the global random state
+    np.random.rand()
+    elfi.new_inference_task()
+    p = elfi.Prior('p', 'uniform')
+    q = elfi.Prior('q', ss.norm)
+    token = make_token(p.structure_token, q.structure_token, ss.norm(1, 2))
+
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(elfi.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([path, env.get('PYTHONPATH', '')])
+    output = subprocess.check_output([sys.executable, '-c', _token_script], env=env)
+    assert output.decode().split()[-1] == token